@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+bench_stub.py
+
+Local stand-in for api.scryfall.com and edhrec.com so edhrec_usage_percent.py can be
+benchmarked without touching the real sites.
+
+- Serves Scryfall card JSON under /scryfall and EDHREC card HTML under /edhrec with a
+  configurable per-request latency, and answers a configurable fraction of requests with
+  429 + Retry-After. EDHREC pages carry an ETag and answer If-None-Match with 304.
+- Cards are synthetic by default. Every tenth card is double-faced and its EDHREC page lives
+  under the front face's slug, reachable through the /route/?cc= redirect Scryfall links to;
+  every 25th card has no EDHREC page at all. --fixtures DIR serves recorded responses
+  instead (DIR/scryfall/*.json card objects, DIR/edhrec/<slug>.html pages); --record DIR
+  writes such a directory from a real .cache/cache.sqlite.
+- Writes a synthetic inventory per --rows size (rows cycle over the card catalog), then runs
+  edhrec_usage_percent.py once per size and --concurrency level, each in a fresh temp dir
+  so every run starts with a cold .cache.
+- Reports cards/second, peak RSS of the run, and request counts per endpoint, and checks
+  every run's ranked CSV matches the first run of the same size. --report saves the results
+  as JSON; --baseline compares against a saved report.
+- --check turns the runs into a pass/fail test of --batch_resolve (added to the pass-through
+  args): each run must make exactly the /cards/collection POSTs the inventory needs (one per
+  75 distinct IDs plus one per 75 distinct name+set), no per-card Scryfall GETs, and produce
+  the same ranking as the first run. Exits non-zero if any run fails.
+
+- --parse_corpus times parse_usage_from_html_fast against the BeautifulSoup parser over saved
+  EDHREC pages (a directory of .html files, or a .cache/cache.sqlite), reports any page
+  where the two disagree, and exits non-zero if there is one.
+
+Usage:
+  py -3.10 bench_stub.py --cards 200 --latency 0.05 --concurrency 1 8 16
+  py -3.10 bench_stub.py --rows 1000 10000 100000 --cards 2000 --concurrency 16 --report base.json
+  py -3.10 bench_stub.py --rows 10000 --concurrency 16 --rate_429 0.05 --baseline base.json -- --batch_resolve
+  py -3.10 bench_stub.py --record fixtures --cache .cache/cache.sqlite
+  py -3.10 bench_stub.py --fixtures fixtures --rows 1000 --concurrency 8
+  py -3.10 bench_stub.py --rows 1000 --cards 400 --latency 0 --concurrency 1 8 --check
+  py -3.10 bench_stub.py --parse_corpus .cache/cache.sqlite
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, quote_plus, urlparse
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "edhrec_usage_percent.py")
+COLORS = ["W", "U", "B", "R", "G"]
+COLLECTION_MAX = 75  # identifiers per Scryfall /cards/collection request
+
+def stub_card(i: int) -> dict:
+    h = hashlib.sha1(str(i).encode()).hexdigest()
+    sid = f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:32]}"
+    ci = [c for j, c in enumerate(COLORS) if (i >> j) & 1]
+    name = f"Stub Card {i}" + (f" // Stub Back {i}" if i % 10 == 5 else "")
+    return {"object": "card", "id": sid, "name": name, "set": "stb", "color_identity": ci,
+            "related_uris": {"edhrec": f"https://edhrec.com/route/?cc={quote_plus(name)}"}}
+
+def stub_slug(name: str) -> str:
+    # EDHREC files double-faced cards under the front face
+    front = name.split(" // ")[0].lower()
+    return "-".join(re.sub(r"[^a-z0-9\s-]+", "", front).split())
+
+def stub_edhrec_html(name: str) -> str:
+    n = int(hashlib.sha1(name.encode()).hexdigest()[:6], 16) % 50000
+    denom = 6886184
+    pct = round(n / denom * 100, 2)
+    filler = "<p>Lorem ipsum dolor sit amet.</p>" * 50
+    return (f"<html><head><title>{name} (Commander Card)</title></head><body>{filler}"
+            f"<div class='card'><span>In {n} decks</span><span>{pct}% of {denom} decks</span></div>"
+            f"{filler}</body></html>")
+
+def load_fixtures(path: str) -> tuple:
+    """(cards, pages by slug) from a directory written by record_fixtures."""
+    cards, pages = [], {}
+    sdir, edir = os.path.join(path, "scryfall"), os.path.join(path, "edhrec")
+    for fn in sorted(os.listdir(sdir)):
+        if fn.endswith(".json"):
+            with open(os.path.join(sdir, fn), encoding="utf-8") as f:
+                cards.append(json.load(f))
+    for fn in sorted(os.listdir(edir)):
+        if fn.endswith(".html"):
+            with open(os.path.join(edir, fn), encoding="utf-8") as f:
+                pages[fn[:-len(".html")]] = f.read()
+    if not cards:
+        raise SystemExit(f"No Scryfall fixtures in {sdir}")
+    return cards, pages
+
+def record_fixtures(cache_path: str, out_dir: str):
+    """Dump the Scryfall cards and EDHREC pages held in a real cache.sqlite as fixture files."""
+    sys.path.insert(0, os.path.dirname(SCRIPT))
+    import edhrec_usage_percent as eup
+    store = eup.CacheStore(cache_path, legacy_dir=os.path.dirname(cache_path))
+    os.makedirs(os.path.join(out_dir, "scryfall"), exist_ok=True)
+    os.makedirs(os.path.join(out_dir, "edhrec"), exist_ok=True)
+    n_cards = n_pages = 0
+    for (key,) in store._db().execute("SELECT key FROM cache WHERE key LIKE 'scry_%' OR key LIKE 'card_html_%'"):
+        data = store.get(key) or {}
+        if key.startswith("card_html_") and data.get("html"):
+            with open(os.path.join(out_dir, "edhrec", key[len("card_html_"):] + ".html"), "w", encoding="utf-8") as f:
+                f.write(data["html"])
+            n_pages += 1
+        elif data.get("object") == "card" and data.get("id"):
+            with open(os.path.join(out_dir, "scryfall", data["id"] + ".json"), "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            n_cards += 1
+    print(f"[record] {n_cards} cards, {n_pages} EDHREC pages -> {out_dir}")
+
+class StubState:
+    def __init__(self, cards: int, latency: float, fixtures: str = None,
+                 rate_429: float = 0.0, retry_after: float = 0.1, seed: int = 1):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        if fixtures:
+            self.cards, self.pages = load_fixtures(fixtures)
+        else:
+            self.cards = [stub_card(i) for i in range(cards)]
+            # Pages are generated on request (None); a few cards EDHREC has no page for
+            self.pages = {stub_slug(c["name"]): None for i, c in enumerate(self.cards) if i % 25 != 24}
+        self.slug_names = {stub_slug(c["name"]): c["name"] for c in self.cards}
+        self.by_id = {c["id"]: c for c in self.cards}
+        self.by_name = {c["name"].lower(): c for c in self.cards}
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def count(self, key: str):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def throttle(self) -> bool:
+        """True if this request should be answered with a 429."""
+        with self.lock:
+            return self.rate_429 > 0 and self.rng.random() < self.rate_429
+
+    def page(self, slug: str) -> Optional[str]:
+        if slug not in self.pages:
+            return None
+        return self.pages[slug] or stub_edhrec_html(self.slug_names[slug])
+
+def make_handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # keep-alive clients otherwise stall on delayed ACKs
+
+        def log_message(self, *a):
+            pass
+
+        def _send(self, status: int, body: str, ctype: str, etag: str = None, location: str = None,
+                  retry_after: float = None):
+            data = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(data)))
+            if etag:
+                self.send_header("ETag", etag)
+            if location:
+                self.send_header("Location", location)
+            if retry_after is not None:
+                self.send_header("Retry-After", f"{retry_after:g}")
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _not_found(self):
+            self._send(404, json.dumps({"object": "error", "status": 404}), "application/json")
+
+        def _throttled(self) -> bool:
+            if not state.throttle():
+                return False
+            state.count("429")
+            self._send(429, json.dumps({"object": "error", "status": 429}), "application/json",
+                       retry_after=state.retry_after)
+            return True
+
+        def do_GET(self):
+            time.sleep(state.latency)
+            if self._throttled():
+                return
+            u = urlparse(self.path)
+            q = parse_qs(u.query)
+            if u.path == "/scryfall/cards/named":
+                state.count("scryfall_named")
+                name = (q.get("exact") or q.get("fuzzy") or [""])[0].lower()
+                card = state.by_name.get(name)
+                if card and q.get("set") and q["set"][0].lower() != card["set"]:
+                    card = None
+                return self._send(200, json.dumps(card), "application/json") if card else self._not_found()
+            if u.path.startswith("/scryfall/cards/"):
+                state.count("scryfall_id")
+                card = state.by_id.get(u.path.rsplit("/", 1)[-1])
+                return self._send(200, json.dumps(card), "application/json") if card else self._not_found()
+            if u.path.rstrip("/") == "/edhrec/route":
+                state.count("edhrec_route")
+                card = state.by_name.get((q.get("cc") or [""])[0].lower())
+                target = f"/edhrec/cards/{stub_slug(card['name'])}" if card else "/edhrec/search"
+                return self._send(302, "", "text/html", location=target)
+            if u.path.startswith("/edhrec/cards/"):
+                state.count("edhrec")
+                html = state.page(u.path.rsplit("/", 1)[-1])
+                if html is None:
+                    return self._send(404, "<html>not found</html>", "text/html")
+                etag = '"%s"' % hashlib.sha1(html.encode()).hexdigest()[:16]
+                if self.headers.get("If-None-Match") == etag:
+                    state.count("edhrec_304")
+                    return self._send(304, "", "text/html", etag)
+                return self._send(200, html, "text/html", etag)
+            self._not_found()
+
+        def do_POST(self):
+            time.sleep(state.latency)
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self._throttled():
+                return
+            if urlparse(self.path).path != "/scryfall/cards/collection":
+                return self._not_found()
+            state.count("scryfall_collection")
+            data, not_found = [], []
+            for ident in json.loads(body or b"{}").get("identifiers", []):
+                if "id" in ident:
+                    card = state.by_id.get(ident["id"])
+                else:
+                    card = state.by_name.get(str(ident.get("name", "")).lower())
+                    if card and "set" in ident and str(ident["set"]).lower() != card["set"]:
+                        card = None
+                if card:
+                    data.append(card)
+                else:
+                    not_found.append(ident)
+            self._send(200, json.dumps({"object": "list", "not_found": not_found, "data": data}), "application/json")
+
+    return Handler
+
+def start_stub(state: StubState) -> ThreadingHTTPServer:
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(state))
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+def write_inventory(path: str, cards: list, rows: int = None):
+    """Inventory of `rows` lines (default one per card), cycling over `cards`."""
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(["Name", "Set code", "Quantity", "Scryfall ID"])
+        for i in range(len(cards) if rows is None else rows):
+            c = cards[i % len(cards)]
+            # Every third row only has a name, so both Scryfall lookup paths get exercised
+            w.writerow([c["name"], c["set"], 1 + i % 4, c["id"] if i % 3 else ""])
+
+def expected_collection_posts(cards: list, rows: int) -> int:
+    """/cards/collection POSTs a cold --batch_resolve run over write_inventory(cards, rows) should make."""
+    ids, name_sets = set(), set()
+    for i in range(rows):
+        c = cards[i % len(cards)]
+        if i % 3:
+            ids.add(c["id"])
+        else:
+            name_sets.add((c["name"].lower(), c["set"].lower()))
+    return math.ceil(len(ids) / COLLECTION_MAX) + math.ceil(len(name_sets) / COLLECTION_MAX)
+
+def check_run(r: dict, cards: list) -> list:
+    """Problems with one --check run (empty if it passed)."""
+    counts = r["counts"]
+    want = expected_collection_posts(cards, r["rows"])
+    problems = []
+    if counts.get("scryfall_collection", 0) != want:
+        problems.append(f"scryfall_collection={counts.get('scryfall_collection', 0)}, expected {want}")
+    for kind in ("scryfall_named", "scryfall_id"):
+        if counts.get(kind, 0):
+            problems.append(f"{kind}={counts[kind]}, expected 0")
+    if not r["same_output"]:
+        problems.append("ranked output differs from the first run")
+    return problems
+
+def run_child(cmd: list, cwd: str, env: dict) -> Optional[float]:
+    """Run cmd to completion; returns its peak RSS in MB where the platform can tell us."""
+    proc = subprocess.Popen(cmd, cwd=cwd, env=env)
+    if hasattr(os, "wait4"):
+        _, status, ru = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        peak = ru.ru_maxrss / (1024 * 1024) if sys.platform == "darwin" else ru.ru_maxrss / 1024
+    else:
+        peak = None
+        try:
+            import psutil  # optional: only needed for peak RSS on Windows
+            ps = psutil.Process(proc.pid)
+            rss = 0
+            while proc.poll() is None:
+                try:
+                    rss = max(rss, ps.memory_info().rss)
+                except psutil.Error:
+                    break
+                time.sleep(0.05)
+            peak = rss / (1024 * 1024)
+        except ImportError:
+            pass
+        proc.wait()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return peak
+
+def run_once(base_url: str, inv: str, concurrency: int, extra: list) -> tuple:
+    """(seconds, ranked CSV text, peak RSS MB or None, the run's --metrics_json report)"""
+    env = dict(os.environ,
+               BULKSIFTER_SCRYFALL_API=base_url + "/scryfall",
+               BULKSIFTER_EDHREC_BASE=base_url + "/edhrec")
+    with tempfile.TemporaryDirectory() as work:
+        outp = os.path.join(work, "ranked.csv")
+        metrics = os.path.join(work, "metrics.json")
+        cmd = [sys.executable, SCRIPT, "--in", inv, "--out", outp, "--quiet", "--flush_every", "0",
+               "--scryfall_rps", "0", "--edhrec_rps", "0", "--metrics_json", metrics,
+               "--concurrency", str(concurrency)] + extra
+        t0 = time.perf_counter()
+        peak = run_child(cmd, work, env)
+        dt = time.perf_counter() - t0
+        with open(outp, encoding="utf-8") as f:
+            out = f.read()
+        with open(metrics, encoding="utf-8") as f:
+            return dt, out, peak, json.load(f)
+
+def load_corpus(path: str) -> dict:
+    """name -> html, from a directory of saved pages or from card_html_* entries in a cache.sqlite."""
+    pages = {}
+    if os.path.isdir(path):
+        for fn in sorted(os.listdir(path)):
+            if fn.endswith((".html", ".htm")):
+                with open(os.path.join(path, fn), encoding="utf-8", errors="replace") as f:
+                    pages[fn] = f.read()
+        return pages
+    sys.path.insert(0, os.path.dirname(SCRIPT))
+    import edhrec_usage_percent as eup
+    store = eup.CacheStore(path, legacy_dir=os.path.dirname(path))
+    for (key,) in store._db().execute("SELECT key FROM cache WHERE key LIKE 'card_html_%'"):
+        html = (store.get(key) or {}).get("html")
+        if html:
+            pages[key] = html
+    return pages
+
+def bench_parser(path: str, repeat: int = 3):
+    sys.path.insert(0, os.path.dirname(SCRIPT))
+    import edhrec_usage_percent as eup
+    pages = load_corpus(path)
+    if not pages:
+        raise SystemExit(f"No pages found in {path}")
+    timings = {}
+    results = {}
+    def fast(html):
+        # The fast path on its own (no bs4 fallback), so its misses show up as mismatches
+        return eup.parse_usage_from_html_fast(html) or (None, None, None)
+
+    for label, fn in (("bs4", eup.parse_usage_from_html_bs4), ("fast", fast)):
+        best = None
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            results[label] = {k: fn(html) for k, html in pages.items()}
+            dt = time.perf_counter() - t0
+            best = dt if best is None else min(best, dt)
+        timings[label] = best
+    mismatches = [k for k in pages if results["bs4"][k] != results["fast"][k]]
+    mb = sum(len(h) for h in pages.values()) / 1e6
+    for label, dt in timings.items():
+        print(f"[parse] {label:>4}: {dt / len(pages) * 1000:8.3f} ms/page  ({len(pages)} pages, {mb:.1f} MB)")
+    print(f"[parse] speedup {timings['bs4'] / timings['fast']:.1f}x, mismatches: {len(mismatches)}")
+    for k in mismatches[:20]:
+        print(f"  ! {k}: bs4={results['bs4'][k]} fast={results['fast'][k]}")
+    if mismatches:
+        sys.exit(1)
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark edhrec_usage_percent.py against a local stub server.")
+    ap.add_argument("--cards", type=int, default=None,
+                    help="Distinct synthetic cards in the stub catalog (default: one per inventory row)")
+    ap.add_argument("--rows", type=int, nargs="+", default=None,
+                    help="Inventory sizes to run, e.g. 1000 10000 100000 (default: --cards, or 200)")
+    ap.add_argument("--latency", type=float, default=0.05, help="Stub latency per request (seconds)")
+    ap.add_argument("--rate_429", type=float, default=0.0, help="Fraction of requests answered with 429")
+    ap.add_argument("--retry_after", type=float, default=0.1, help="Retry-After seconds sent with each 429")
+    ap.add_argument("--seed", type=int, default=1, help="Seed for which requests get a 429")
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 16], help="Concurrency levels to run")
+    ap.add_argument("--fixtures", help="Serve recorded responses from this directory instead of synthetic cards")
+    ap.add_argument("--record", metavar="DIR", help="Write fixtures from --cache into DIR and exit")
+    ap.add_argument("--cache", default=os.path.join(".cache", "cache.sqlite"), help="cache.sqlite to --record from")
+    ap.add_argument("--report", help="Save the results as JSON (for a later --baseline)")
+    ap.add_argument("--baseline", help="Compare cards/s against a report saved with --report")
+    ap.add_argument("--check", action="store_true",
+                    help="Fail (exit 1) unless every run makes the expected /cards/collection requests and no per-card Scryfall GETs")
+    ap.add_argument("--parse_corpus", help="Benchmark/compare the HTML parsers over saved pages (dir or cache.sqlite) and exit")
+    ap.add_argument("extra", nargs=argparse.REMAINDER, help="Extra args passed through to edhrec_usage_percent.py (after --)")
+    args = ap.parse_args()
+    extra = [a for a in args.extra if a != "--"]
+    if args.check and "--batch_resolve" not in extra:
+        extra.append("--batch_resolve")
+    if args.parse_corpus:
+        return bench_parser(args.parse_corpus)
+    if args.record:
+        return record_fixtures(args.cache, args.record)
+
+    sizes = args.rows or [args.cards or 200]
+    state = StubState(args.cards or max(sizes), args.latency, args.fixtures,
+                      args.rate_429, args.retry_after, args.seed)
+    srv = start_stub(state)
+    base_url = f"http://127.0.0.1:{srv.server_address[1]}"
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = {(r["rows"], r["concurrency"], " ".join(r["extra"])): r for r in json.load(f)["runs"]}
+
+    results = []
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            inv = os.path.join(tmp, f"inventory_{size}.csv")
+            write_inventory(inv, state.cards, size)
+            first = None
+            for conc in args.concurrency:
+                state.counts.clear()
+                dt, out, peak, metrics = run_once(base_url, inv, conc, extra)
+                if first is None:
+                    first = out
+                counts = dict(state.counts)
+                r = {"rows": size, "concurrency": conc, "extra": extra, "seconds": round(dt, 3),
+                     "cards_per_s": round(size / dt, 2), "peak_rss_mb": round(peak, 1) if peak else None,
+                     "requests": sum(v for k, v in counts.items() if k != "edhrec_304"), "counts": counts,
+                     "same_output": out == first, "stages": metrics.get("stages", {})}
+                results.append(r)
+                by_kind = " ".join(f"{k}={v}" for k, v in sorted(counts.items()))
+                rss = f"{peak:7.1f} MB" if peak else "      ? MB"
+                line = (f"[bench] rows={size:>7} concurrency={conc:>3}  {dt:8.2f}s  {r['cards_per_s']:9.1f} cards/s  "
+                        f"peak {rss}  requests={r['requests']} ({by_kind})  "
+                        f"output={'same' if r['same_output'] else 'DIFFERENT'}")
+                base = baseline.get((size, conc, " ".join(extra)))
+                if base:
+                    line += f"  vs baseline {r['cards_per_s'] / base['cards_per_s']:.2f}x"
+                if args.check:
+                    problems = check_run(r, state.cards)
+                    line += "  check=" + ("ok" if not problems else "FAIL")
+                    failures += [f"rows={size} concurrency={conc}: {p}" for p in problems]
+                print(line, flush=True)
+
+    srv.shutdown()
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"latency": args.latency, "rate_429": args.rate_429, "fixtures": args.fixtures,
+                       "runs": results}, f, indent=2)
+        print(f"[bench] report -> {args.report}")
+    if failures:
+        for f in failures:
+            print(f"[check] FAIL {f}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
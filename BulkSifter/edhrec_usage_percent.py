@@ -10,30 +10,89 @@ edhrec_usage_percent.py (v2)
 - Marks top 10% by % and top 10% by numerator with boolean columns and a combined "highlight" column.
 
 Usage:
-  py -3.10 edhrec_usage_percent.py --in "Large Boxes.csv" --out ranked_usage.csv --flush_every 50 --sleep 0.2
+  py -3.10 edhrec_usage_percent.py --in "Large Boxes.csv" --out ranked_usage.csv --flush_every 50
+  py -3.10 edhrec_usage_percent.py --in "Large Boxes.csv" --out ranked_usage.csv --concurrency 8 --batch_resolve
+
+With --concurrency > 1 cards are enriched on a bounded thread pool; the output order
+matches the serial run. Requests go over one keep-alive session per host, paced by a
+token bucket per host (--scryfall_rps / --edhrec_rps) that slows down when the server
+answers 429. 429/5xx and connection errors are retried with exponential backoff,
+honouring Retry-After. --batch_resolve resolves the whole inventory
+through Scryfall's /cards/collection endpoint (75 cards per request) first.
+Finished rows are journaled to .cache/runs/<input sha1>.jsonl; if a run dies, rerun
+with --resume to pick up where it stopped.
+--previous ranked_usage.csv only enriches rows that are new since that ranking (matched by
+Scryfall ID, else name + set) or whose EDHREC data is older than --previous_max_age_hours
+(default a week); the rest are carried forward and the top-10% flags recomputed over everything.
+--bulk_json default-cards.json resolves everything from a local Scryfall bulk dump
+(https://scryfall.com/docs/api/bulk-data), indexed once into .cache/scryfall_bulk.sqlite.
+EDHREC slugs that can't be guessed from the name (split/double-faced cards etc.) are found
+by following Scryfall's EDHREC link once and remembered in the cache; --edhrec_sitemap
+takes a saved EDHREC sitemap to look them up without any request.
+Lookups that fail for good (unknown card name or Scryfall ID, no EDHREC page) are cached
+too, with a reason code, and retried after --negative_ttl_hours.
+--metrics_json run.json writes p50/p95/p99 timings per stage (load, resolve, fetch, parse,
+flush, sort, ...), cache hit/miss counts and HTTP status/bytes per host; --progress shows
+a live one-line summary on stderr.
+--in/--out also take .parquet files; the ranked Parquet has typed columns (Int64 qty and
+deck counts, Float64 percentages, boolean flags).
 
 Dependencies:
   pip install requests pandas beautifulsoup4
+  pip install pyarrow   (optional: .parquet --in/--out)
 """
 
 import argparse
+import codecs
+import hashlib
 import json
+import math
+import multiprocessing
 import os
+import random
 import re
+import sqlite3
+import sys
+import threading
 import time
-from dataclasses import dataclass
-from typing import List, Optional, Tuple
+import unicodedata
+import zlib
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, replace
+from email.utils import parsedate_to_datetime
+from html import unescape
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
 
 import requests
+import requests.adapters
 import pandas as pd
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
 from bs4 import BeautifulSoup
 
-SCRYFALL_ID_URL = "https://api.scryfall.com/cards/{id}"
-SCRYFALL_NAMED_URL = "https://api.scryfall.com/cards/named"
-EDHREC_CARD_URL = "https://edhrec.com/cards/{slug}"
+# Base URLs can be overridden (e.g. to point at bench_stub.py's local server)
+SCRYFALL_API = os.environ.get("BULKSIFTER_SCRYFALL_API", "https://api.scryfall.com")
+EDHREC_BASE = os.environ.get("BULKSIFTER_EDHREC_BASE", "https://edhrec.com")
+
+SCRYFALL_ID_URL = SCRYFALL_API + "/cards/{id}"
+SCRYFALL_NAMED_URL = SCRYFALL_API + "/cards/named"
+SCRYFALL_COLLECTION_URL = SCRYFALL_API + "/cards/collection"
+SCRYFALL_COLLECTION_MAX = 75  # identifiers per /cards/collection request
+EDHREC_CARD_URL = EDHREC_BASE + "/cards/{slug}"
 
 CACHE_DIR = ".cache"
 os.makedirs(CACHE_DIR, exist_ok=True)
+CACHE_DB_PATH = os.path.join(CACHE_DIR, "cache.sqlite")
+# Seconds before a cached entry is considered stale, per source
+# (set from --scryfall_ttl_days / --edhrec_ttl_hours / --negative_ttl_hours)
+CACHE_TTL = {
+    "scryfall": 30 * 86400,   # card objects barely change
+    "edhrec": 24 * 3600,      # deck counts drift daily
+    "negative": 6 * 3600,     # failed lookups; short so typo fixes and new cards show up soon
+}
+BULK_INDEX_PATH = os.path.join(CACHE_DIR, "scryfall_bulk.sqlite")
 
 @dataclass
 class CardRow:
@@ -53,11 +112,228 @@ class Enriched:
     edh_num_decks: Optional[int]       # numerator
     edh_total_decks: Optional[int]     # denominator
     notes: str
+    top10_by_pct: bool = False
+    top10_by_num: bool = False
+    highlight: bool = False
+    scryfall_id: Optional[str] = None  # the resolved card (None if Scryfall couldn't resolve the row)
+    inventory_key: Optional[str] = None  # row_key() of the inventory row, as spelled there (for --previous)
 
 def log(msg: str, enabled: bool=True):
     if enabled:
         print(msg, flush=True)
 
+def percentile(sorted_vals: List[float], p: float) -> Optional[float]:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_vals:
+        return None
+    k = max(0, min(len(sorted_vals) - 1, math.ceil(p / 100.0 * len(sorted_vals)) - 1))
+    return sorted_vals[k]
+
+class Metrics:
+    """
+    Run-wide instrumentation, shared by all worker threads:
+    - per-stage latency samples (load, resolve, fetch, parse, flush, sort, write, and
+      http_<source> per request), reported as count/total/p50/p95/p99/max
+    - cache hit/miss/revalidated/negative counts per source
+    - HTTP status histogram and response bytes per source
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples: dict = {}
+        self.cache: dict = {}
+        self.status: dict = {}
+        self.bytes = Counter()
+        self.cards = 0
+        self.started = time.perf_counter()
+
+    def observe(self, stage: str, seconds: float):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    @contextmanager
+    def timed(self, stage: str):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t)
+
+    def cache_event(self, source: str, kind: str):
+        with self.lock:
+            self.cache.setdefault(source, Counter())[kind] += 1
+
+    def http(self, source: str, status, nbytes: int, seconds: float):
+        with self.lock:
+            self.status.setdefault(source, Counter())[str(status)] += 1
+            self.bytes[source] += nbytes
+            self.samples.setdefault(f"http_{source}", []).append(seconds)
+
+    def card_done(self):
+        with self.lock:
+            self.cards += 1
+
+    def report(self) -> dict:
+        with self.lock:
+            stages = {}
+            for stage, vals in self.samples.items():
+                vals = sorted(vals)
+                ms = lambda v: round(v * 1000, 3)
+                stages[stage] = {
+                    "count": len(vals), "total_s": round(sum(vals), 3),
+                    "p50_ms": ms(percentile(vals, 50)), "p95_ms": ms(percentile(vals, 95)),
+                    "p99_ms": ms(percentile(vals, 99)), "max_ms": ms(vals[-1]),
+                }
+            wall = time.perf_counter() - self.started
+            return {
+                "cards": self.cards,
+                "wall_s": round(wall, 3),
+                "cards_per_s": round(self.cards / wall, 2) if wall > 0 else None,
+                "stages": stages,
+                "cache": {src: dict(c) for src, c in self.cache.items()},
+                "http": {src: {"requests": sum(c.values()), "status": dict(c), "bytes": self.bytes[src]}
+                         for src, c in self.status.items()},
+            }
+
+    def progress_line(self, total: int) -> str:
+        with self.lock:
+            wall = time.perf_counter() - self.started
+            rate = self.cards / wall if wall > 0 else 0.0
+            eta = (total - self.cards) / rate if rate > 0 else 0.0
+            reqs = " ".join(f"{src}={sum(c.values())}" for src, c in sorted(self.status.items()))
+            hits = sum(c["hit"] for c in self.cache.values())
+            looks = sum(sum(c.values()) for c in self.cache.values())
+        hit_pct = f"{hits / looks * 100:.0f}%" if looks else "-"
+        return (f"[progress] {self.cards}/{total} cards  {rate:.1f}/s  eta {eta:.0f}s  "
+                f"requests {reqs or '-'}  cache hits {hit_pct}")
+
+METRICS = Metrics()
+
+class TokenBucket:
+    """
+    Per-host request pacing shared by all worker threads: `rate` tokens/second, bursts up to `burst`.
+
+    Adaptive: a 429 halves the rate (down to `floor`) and blocks every thread until the
+    server's Retry-After has passed; each success afterwards wins back 5% of the gap to the
+    configured rate.
+    """
+    def __init__(self, rate: float = 0.0, burst: float = 1.0, floor: float = 0.2):
+        self._lock = threading.Lock()
+        self.burst = burst
+        self.floor = floor
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            self.target = rate if rate and rate > 0 else 0.0
+            self.rate = self.target
+            self._tokens = self.burst
+            self._stamp = time.monotonic()
+            self._blocked_until = 0.0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    delay = self._blocked_until - now
+                elif self.rate <= 0:
+                    return
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                    self._stamp = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+    def throttled(self, retry_after: float):
+        with self._lock:
+            if self.rate > 0:
+                self.rate = max(self.floor, self.rate / 2)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            self._tokens = 0
+
+    def succeeded(self):
+        if self.rate < self.target:
+            with self._lock:
+                self.rate = min(self.target, self.rate + (self.target - self.rate) * 0.05 + 0.01)
+
+RATE_LIMITERS = {
+    "scryfall": TokenBucket(),
+    "edhrec": TokenBucket(),
+}
+
+HTTP_MAX_RETRIES = 5
+HTTP_BACKOFF_BASE = 1.0    # seconds; doubles each retry
+HTTP_BACKOFF_MAX = 60.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_SESSIONS: dict = {}
+_SESSIONS_LOCK = threading.Lock()
+HTTP_POOL_SIZE = 16
+
+def get_session(source: str) -> requests.Session:
+    """One keep-alive Session per host, shared by the worker threads."""
+    with _SESSIONS_LOCK:
+        sess = _SESSIONS.get(source)
+        if sess is None:
+            sess = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            sess.mount("http://", adapter)
+            sess.mount("https://", adapter)
+            _SESSIONS[source] = sess
+        return sess
+
+def retry_after_seconds(r: Optional[requests.Response], attempt: int) -> float:
+    """Server's Retry-After (seconds or HTTP date) if given, else exponential backoff with jitter."""
+    value = r.headers.get("Retry-After") if r is not None else None
+    if value:
+        try:
+            return min(HTTP_BACKOFF_MAX, max(0.0, float(value)))
+        except ValueError:
+            try:
+                return min(HTTP_BACKOFF_MAX, max(0.0, parsedate_to_datetime(value).timestamp() - time.time()))
+            except (TypeError, ValueError):
+                pass
+    return min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)) * (0.5 + random.random() / 2)
+
+def http_request(method: str, source: str, url: str, **kwargs) -> requests.Response:
+    """
+    Rate-limited request over the host's pooled session. 429/5xx responses and connection
+    errors are retried up to HTTP_MAX_RETRIES times; after that the last response is
+    returned (or the connection error re-raised).
+    """
+    bucket = RATE_LIMITERS[source]
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        bucket.acquire()
+        t = time.perf_counter()
+        try:
+            r = get_session(source).request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            METRICS.http(source, "error", 0, time.perf_counter() - t)
+            if attempt == HTTP_MAX_RETRIES:
+                raise
+            time.sleep(retry_after_seconds(None, attempt))
+            continue
+        METRICS.http(source, r.status_code, len(r.content), time.perf_counter() - t)
+        if r.status_code not in RETRY_STATUSES or attempt == HTTP_MAX_RETRIES:
+            if r.status_code < 400:
+                bucket.succeeded()
+            return r
+        wait = retry_after_seconds(r, attempt)
+        if r.status_code == 429:
+            bucket.throttled(wait)
+        else:
+            time.sleep(wait)
+    return r
+
+def http_get(source: str, url: str, **kwargs) -> requests.Response:
+    return http_request("GET", source, url, **kwargs)
+
+def http_post(source: str, url: str, **kwargs) -> requests.Response:
+    return http_request("POST", source, url, **kwargs)
+
 def detect_columns(df: pd.DataFrame) -> Tuple[str, Optional[str], Optional[str], Optional[str]]:
     cols = {c.lower().strip(): c for c in df.columns}
     def pick(cands):
@@ -75,113 +351,717 @@ def detect_columns(df: pd.DataFrame) -> Tuple[str, Optional[str], Optional[str],
         raise ValueError("Couldn't detect a card name column. Include 'Name' or 'Card Name'.")
     return name_col, set_col, qty_col, sfid_col
 
-def read_inventory(path: str, verbose: bool) -> List[CardRow]:
-    encodings = ["utf-8-sig","latin-1"]
-    df = None
-    for enc in encodings:
+INVENTORY_ENCODINGS = ["utf-8-sig", "latin-1"]
+
+def detect_encoding(path: str) -> str:
+    """First of INVENTORY_ENCODINGS that decodes the whole file (checked in 1 MB pieces)."""
+    for enc in INVENTORY_ENCODINGS[:-1]:
+        dec = codecs.getincrementaldecoder(enc)()
         try:
-            df = pd.read_csv(path, dtype=str, encoding=enc)
-            break
-        except Exception:
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    dec.decode(block)
+                dec.decode(b"", final=True)
+            return enc
+        except UnicodeDecodeError:
             continue
-    if df is None:
-        raise RuntimeError("Failed to read CSV; try saving as UTF-8.")
-    name_col, set_col, qty_col, sfid_col = detect_columns(df)
+    return INVENTORY_ENCODINGS[-1]
 
-    rows: List[CardRow] = []
-    for _, r in df.iterrows():
-        name = str(r[name_col]).strip() if pd.notna(r.get(name_col)) else ""
-        if not name:
-            continue
-        set_code = None
-        if set_col and pd.notna(r.get(set_col)):
-            set_code = str(r[set_col]).strip() or None
-        qty = 1
-        if qty_col and pd.notna(r.get(qty_col)):
-            try:
-                qty = int(str(r[qty_col]).strip())
-            except Exception:
-                qty = 1
-        scryfall_id = None
-        if sfid_col and pd.notna(r.get(sfid_col)):
-            sid = str(r[sfid_col]).strip()
-            scryfall_id = sid if sid else None
-        rows.append(CardRow(name=name, set_code=set_code, qty=qty, scryfall_id=scryfall_id))
+def _clean_column(df: pd.DataFrame, col: Optional[str]) -> Optional[pd.Series]:
+    """Stripped strings with blanks turned into NA (None if the column isn't present)."""
+    if not col:
+        return None
+    s = df[col].astype("string").str.strip()
+    return s.mask(s == "")
+
+def rows_from_frame(df: pd.DataFrame, name_col: str, set_col: Optional[str],
+                    qty_col: Optional[str], sfid_col: Optional[str]) -> List[CardRow]:
+    """Column-wise normalization of one inventory DataFrame into CardRows (rows without a name are dropped)."""
+    names = _clean_column(df, name_col)
+    keep = names.notna()
+    n = int(keep.sum())
+
+    def values(s: Optional[pd.Series]) -> list:
+        if s is None:
+            return [None] * n
+        s = s[keep]
+        return s.astype(object).where(s.notna(), None).tolist()
+
+    if qty_col and is_numeric_dtype(df[qty_col]) and not is_bool_dtype(df[qty_col]):
+        # Typed (Parquet) column; integer columns with gaps come back as float64. Whole numbers
+        # are kept, anything else (NaN, 2.5, inf) defaults to 1
+        q = pd.to_numeric(df[qty_col][keep], errors="coerce").astype("float64")
+        qtys = q.where((q % 1) == 0).fillna(1).astype("int64").tolist()
+    elif qty_col:
+        q = _clean_column(df, qty_col)[keep]
+        # Same rule as int(str(x)): optional sign and digits only, anything else defaults to 1
+        q = pd.to_numeric(q.where(q.str.fullmatch(r"[+-]?\d+").fillna(False)), errors="coerce")
+        qtys = q.fillna(1).astype("int64").tolist()
+    else:
+        qtys = [1] * n
+
+    return [CardRow(name=nm, set_code=sc, qty=qt, scryfall_id=sid)
+            for nm, sc, qt, sid in zip(values(names), values(_clean_column(df, set_col)), qtys,
+                                       values(_clean_column(df, sfid_col)))]
+
+PARQUET_EXTS = (".parquet", ".pq")
 
+def is_parquet(path: str) -> bool:
+    return path.lower().endswith(PARQUET_EXTS)
+
+def require_pyarrow():
+    """pyarrow.parquet, which is only needed for .parquet input/output."""
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet input/output needs pyarrow: pip install pyarrow (or use a .csv path).")
+    return pq
+
+def iter_inventory(path: str, verbose: bool, chunksize: int = 50000) -> Iterator[List[CardRow]]:
+    """Read the inventory (CSV, or Parquet) `chunksize` lines at a time, yielding each chunk's CardRows."""
+    if is_parquet(path):
+        pf = require_pyarrow().ParquetFile(path)
+        reader = (batch.to_pandas() for batch in pf.iter_batches(batch_size=chunksize))
+        first = next(reader, None)
+        if first is None:
+            # No rows at all: carry on with just the columns, like a header-only CSV
+            first = pf.schema_arrow.empty_table().to_pandas()
+    else:
+        enc = detect_encoding(path)
+        try:
+            reader = pd.read_csv(path, dtype=str, encoding=enc, chunksize=chunksize)
+            first = next(reader, None)
+        except Exception:
+            raise RuntimeError("Failed to read CSV; try saving as UTF-8.")
+        if first is None:
+            raise RuntimeError("Failed to read CSV; try saving as UTF-8.")
+    name_col, set_col, qty_col, sfid_col = detect_columns(first)
     log(f"[load] Detected columns: name='{name_col}', set='{set_col}', qty='{qty_col}', scryfall_id='{sfid_col}'", verbose)
+
+    yield rows_from_frame(first, name_col, set_col, qty_col, sfid_col)
+    for chunk in reader:
+        yield rows_from_frame(chunk, name_col, set_col, qty_col, sfid_col)
+
+def read_inventory(path: str, verbose: bool, chunksize: int = 50000) -> List[CardRow]:
+    rows: List[CardRow] = []
+    for chunk in iter_inventory(path, verbose, chunksize):
+        rows.extend(chunk)
     log(f"[load] Loaded {len(rows)} rows from {path}", verbose)
     return rows
 
 def slugify_card_name(name: str) -> str:
-    slug = name.lower()
-    replacements = {
-        "'": "", ",": "", ":": "", ";": "", "—": "-", "–": "-",
-        " // ": " ", "//": " ", "  ": " "
-    }
-    for a,b in replacements.items():
-        slug = slug.replace(a,b)
+    """Best guess at EDHREC's slug: ASCII-folded, lowercase, [a-z0-9-] only ("Lim-Dûl's Vault" -> "lim-duls-vault")."""
+    slug = unicodedata.normalize("NFKD", name.replace("Æ", "Ae").replace("æ", "ae"))
+    slug = "".join(c for c in slug if not unicodedata.combining(c)).lower()
+    slug = slug.replace("—", "-").replace("–", "-").replace("//", " ")
+    slug = re.sub(r"[^a-z0-9\s-]+", "", slug)
     slug = "-".join(slug.strip().split())
-    return slug
+    return re.sub(r"-{2,}", "-", slug)
+
+def slug_candidates(name: str) -> List[str]:
+    """Slugs worth checking against a sitemap: the full name, then the front face of a split/DFC name."""
+    out = [slugify_card_name(name)]
+    if "//" in name:
+        out.append(slugify_card_name(name.split("//")[0]))
+    return [c for i, c in enumerate(out) if c and c not in out[:i]]
+
+def load_edhrec_sitemap(path: str) -> set:
+    """Card slugs from a saved EDHREC sitemap (XML or a plain list of URLs)."""
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        return set(re.findall(r"/cards/([a-z0-9-]+)", f.read()))
+
+EDHREC_SITEMAP_SLUGS: Optional[set] = None
+
+@dataclass
+class CacheEntry:
+    data: dict
+    updated: float                # when the payload was last fetched or revalidated
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
 
-def cache_get(key: str) -> Optional[dict]:
-    fp = os.path.join(CACHE_DIR, key + ".json")
-    if os.path.exists(fp):
+    def fresh(self, ttl: Optional[float]) -> bool:
+        return ttl is None or (time.time() - self.updated) < ttl
+
+class CacheStore:
+    """
+    Single-file key/value cache (sqlite in WAL mode) replacing the old one-JSON-file-per-key layout.
+
+    Values are JSON, zlib-compressed. Each thread gets its own connection; WAL lets readers
+    run alongside a writer, and busy_timeout makes concurrent writers queue instead of failing.
+    On first open, any legacy CACHE_DIR/*.json entries are imported (the files are left in place).
+
+    Rows also carry the validators (ETag / Last-Modified) a payload was served with, its size
+    and a last-access time, so callers can revalidate stale entries and evict() can trim the
+    least recently used ones.
+    """
+    TOUCH_EVERY = 3600  # only rewrite `accessed` when it is at least this old (seconds)
+
+    def __init__(self, path: str = CACHE_DB_PATH, legacy_dir: str = CACHE_DIR):
+        self.path = path
+        self._local = threading.local()
+        con = self._db()
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL")  # only takes effect on a new file
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, data BLOB NOT NULL, updated REAL NOT NULL)")
+        con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        cols = {r[1] for r in con.execute("PRAGMA table_info(cache)")}
+        for col, decl in (("accessed", "REAL"), ("size", "INTEGER"), ("etag", "TEXT"), ("last_modified", "TEXT")):
+            if col not in cols:
+                con.execute(f"ALTER TABLE cache ADD COLUMN {col} {decl}")
+        con.execute("UPDATE cache SET accessed=updated, size=length(data) WHERE accessed IS NULL")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache(accessed)")
+        if con.execute("SELECT 1 FROM meta WHERE key='legacy_imported'").fetchone() is None:
+            self.import_legacy_dir(legacy_dir)
+
+    def _db(self) -> sqlite3.Connection:
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            con.execute("PRAGMA synchronous=NORMAL")
+            self._local.con = con
+        return con
+
+    @staticmethod
+    def _pack(data: dict) -> bytes:
+        return zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"), 6)
+
+    @staticmethod
+    def _unpack(blob: bytes) -> dict:
+        return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+    def get_entry(self, key: str) -> Optional[CacheEntry]:
+        """The stored entry regardless of age (None if missing or unreadable)."""
         try:
-            with open(fp, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
+            con = self._db()
+            row = con.execute("SELECT data, updated, etag, last_modified, accessed FROM cache WHERE key=?",
+                              (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if (row[4] or 0) < now - self.TOUCH_EVERY:
+                con.execute("UPDATE cache SET accessed=? WHERE key=?", (now, key))
+            return CacheEntry(self._unpack(row[0]), row[1], row[2], row[3])
+        except (sqlite3.Error, zlib.error, ValueError):
             return None
-    return None
 
-def cache_set(key: str, data: dict) -> None:
-    fp = os.path.join(CACHE_DIR, key + ".json")
-    try:
-        with open(fp, "w", encoding="utf-8") as f:
-            json.dump(data, f)
-    except Exception:
-        pass
+    def get(self, key: str, ttl: Optional[float] = None) -> Optional[dict]:
+        e = self.get_entry(key)
+        return e.data if e is not None and e.fresh(ttl) else None
+
+    def set(self, key: str, data: dict, etag: Optional[str] = None, last_modified: Optional[str] = None) -> None:
+        blob = self._pack(data)
+        now = time.time()
+        try:
+            self._db().execute("INSERT OR REPLACE INTO cache (key, data, updated, accessed, size, etag, last_modified) "
+                               "VALUES (?,?,?,?,?,?,?)", (key, blob, now, now, len(blob), etag, last_modified))
+        except sqlite3.Error:
+            pass
+
+    def touch(self, key: str) -> None:
+        """Mark an entry as just revalidated (e.g. after a 304)."""
+        now = time.time()
+        try:
+            self._db().execute("UPDATE cache SET updated=?, accessed=? WHERE key=?", (now, now, key))
+        except sqlite3.Error:
+            pass
+
+    def evict(self, max_bytes: int) -> int:
+        """Drop least-recently-used entries until the stored payloads fit in max_bytes. Returns the count dropped."""
+        con = self._db()
+        total = con.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= max_bytes:
+            return 0
+        doomed = []
+        for key, size in con.execute("SELECT key, size FROM cache ORDER BY accessed ASC"):
+            if total <= max_bytes:
+                break
+            doomed.append((key,))
+            total -= size or 0
+        con.execute("BEGIN")
+        con.executemany("DELETE FROM cache WHERE key=?", doomed)
+        con.execute("COMMIT")
+        con.execute("PRAGMA incremental_vacuum")
+        return len(doomed)
+
+    def import_legacy_dir(self, legacy_dir: str) -> int:
+        """Import <legacy_dir>/<key>.json files written by the old cache_set. Returns the count imported."""
+        n = 0
+        con = self._db()
+        if os.path.isdir(legacy_dir):
+            con.execute("BEGIN")
+            for fn in os.listdir(legacy_dir):
+                if not fn.endswith(".json"):
+                    continue
+                fp = os.path.join(legacy_dir, fn)
+                try:
+                    with open(fp, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                except Exception:
+                    continue
+                blob = self._pack(data)
+                mtime = os.path.getmtime(fp)
+                con.execute("INSERT OR IGNORE INTO cache (key, data, updated, accessed, size) VALUES (?,?,?,?,?)",
+                            (fn[:-5], blob, mtime, mtime, len(blob)))
+                n += 1
+            con.execute("COMMIT")
+        con.execute("INSERT OR REPLACE INTO meta VALUES ('legacy_imported', ?)", (str(n),))
+        if n:
+            log(f"[cache] Imported {n} legacy {legacy_dir}/*.json entries into {self.path} (the .json files can now be deleted)")
+        return n
+
+_CACHE: Optional[CacheStore] = None
+_CACHE_LOCK = threading.Lock()
+
+def get_cache() -> CacheStore:
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                _CACHE = CacheStore()
+    return _CACHE
+
+def cache_get(key: str, ttl: Optional[float] = None) -> Optional[dict]:
+    return get_cache().get(key, ttl)
+
+def cache_set(key: str, data: dict, etag: Optional[str] = None, last_modified: Optional[str] = None) -> None:
+    get_cache().set(key, data, etag, last_modified)
+
+def cache_negative(key: str, reason: str) -> None:
+    """Remember that a lookup failed for good (e.g. "http_404", "not_found") so reruns skip it."""
+    cache_set(key, {"negative": True, "reason": reason})
+
+def cache_lookup(key: str, ttl: float) -> Optional[dict]:
+    """cache_get for keys that may hold a negative entry; those expire after CACHE_TTL["negative"] instead."""
+    entry = get_cache().get_entry(key)
+    if entry is None:
+        return None
+    if entry.data.get("negative"):
+        ttl = min(ttl, CACHE_TTL["negative"])
+    return entry.data if entry.fresh(ttl) else None
+
+def is_definite_miss(status: int) -> bool:
+    """4xx other than 408/429: asking again won't help, so the failure is worth caching."""
+    return 400 <= status < 500 and status not in (408, 429)
+
+def revalidation_headers(entry: Optional[CacheEntry]) -> dict:
+    """Conditional-request headers for a stale cache entry, if the server gave us validators."""
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+    return headers
+
+def normalize_name(name: str) -> str:
+    """Accent/case/punctuation-insensitive form of a card name ("Æther Vial" -> "aether vial")."""
+    s = unicodedata.normalize("NFKD", name.replace("Æ", "Ae").replace("æ", "ae"))
+    s = "".join(c for c in s if not unicodedata.combining(c)).lower()
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", s).split())
+
+def iter_json_array(path: str, chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """Yield the elements of a top-level JSON array one at a time without loading the whole file."""
+    dec = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf = f.read(chunk_size)
+        pos = buf.index("[") + 1
+        eof = False
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            try:
+                obj, end = dec.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more = f.read(chunk_size)
+                eof = not more
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            yield obj
+            pos = end
+            if len(buf) - pos < chunk_size // 2 and not eof:
+                more = f.read(chunk_size)
+                eof = not more
+                buf = buf[pos:] + more
+                pos = 0
+
+def _trigrams(s: str) -> set:
+    s = f"  {s} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+class ScryfallBulkIndex:
+    """
+    Local lookup table built from a Scryfall "default cards" bulk dump.
+
+    The dump is stream-parsed once into a sqlite file (BULK_INDEX_PATH) holding a compact copy
+    of each card, keyed by ID, by exact name (+set) and by normalized name. The index is rebuilt
+    only when the dump's size/mtime change. Fuzzy lookups use an in-process trigram index
+    over the distinct normalized names, built on first use.
+    """
+    KEEP = ("id", "name", "set", "color_identity", "released_at")
+
+    def __init__(self, dump_path: str, db_path: str = BULK_INDEX_PATH, verbose: bool = True):
+        self.dump_path = dump_path
+        self.db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._trigram_index = None  # trigram -> list of norm names
+        self._verbose = verbose
+        st = os.stat(dump_path)
+        self._stamp = f"{st.st_size}:{int(st.st_mtime)}"
+        if self._meta("stamp") != self._stamp:
+            self._build()
+
+    def _db(self) -> sqlite3.Connection:
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._local.con = con
+        return con
+
+    def _meta(self, key: str) -> Optional[str]:
+        try:
+            row = self._db().execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+    def _compact(self, card: dict) -> dict:
+        out = {k: card[k] for k in self.KEEP if k in card}
+        edh = (card.get("related_uris") or {}).get("edhrec")
+        if edh:
+            out["related_uris"] = {"edhrec": edh}
+        return out
+
+    def _build(self):
+        log(f"[bulk] Indexing {self.dump_path} -> {self.db_path}", self._verbose)
+        t0 = time.time()
+        con = self._db()
+        con.executescript("""
+            DROP TABLE IF EXISTS cards; DROP TABLE IF EXISTS names; DROP TABLE IF EXISTS meta;
+            CREATE TABLE cards (id TEXT PRIMARY KEY, set_code TEXT, released TEXT, data TEXT);
+            CREATE TABLE names (name_lc TEXT, norm TEXT, id TEXT);
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        n = 0
+        batch_cards, batch_names = [], []
+        for card in iter_json_array(self.dump_path):
+            if card.get("object") != "card" or not card.get("id"):
+                continue
+            compact = self._compact(card)
+            batch_cards.append((card["id"], (card.get("set") or "").lower(), card.get("released_at") or "",
+                                json.dumps(compact, separators=(",", ":"))))
+            # Index the full name and each face name ("Fire // Ice" is also findable as "Fire")
+            names = {card.get("name") or ""}
+            names.update(face.get("name") or "" for face in card.get("card_faces") or [])
+            for nm in names:
+                if nm:
+                    batch_names.append((nm.lower(), normalize_name(nm), card["id"]))
+            n += 1
+            if len(batch_cards) >= 5000:
+                con.executemany("INSERT OR REPLACE INTO cards VALUES (?,?,?,?)", batch_cards)
+                con.executemany("INSERT INTO names VALUES (?,?,?)", batch_names)
+                batch_cards, batch_names = [], []
+        con.executemany("INSERT OR REPLACE INTO cards VALUES (?,?,?,?)", batch_cards)
+        con.executemany("INSERT INTO names VALUES (?,?,?)", batch_names)
+        con.executescript("""
+            CREATE INDEX idx_names_lc ON names(name_lc);
+            CREATE INDEX idx_names_norm ON names(norm);
+        """)
+        con.execute("INSERT INTO meta VALUES ('stamp', ?)", (self._stamp,))
+        con.commit()
+        log(f"[bulk] Indexed {n} cards in {time.time() - t0:.1f}s", self._verbose)
+
+    def _one(self, sql: str, params: tuple) -> Optional[dict]:
+        row = self._db().execute(sql, params).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def by_id(self, sid: str) -> Optional[dict]:
+        return self._one("SELECT data FROM cards WHERE id=?", (sid.lower(),))
+
+    def by_name(self, name: str, set_code: Optional[str] = None) -> Optional[dict]:
+        """Exact (case-insensitive) name match, newest printing first; restricted to set_code if given."""
+        sql = "SELECT c.data FROM names n JOIN cards c ON c.id = n.id WHERE n.name_lc=?"
+        params: tuple = (name.lower(),)
+        if set_code:
+            sql += " AND c.set_code=?"
+            params += (set_code.lower(),)
+        return self._one(sql + " ORDER BY c.released DESC LIMIT 1", params)
+
+    def by_norm(self, norm: str) -> Optional[dict]:
+        return self._one("SELECT c.data FROM names n JOIN cards c ON c.id = n.id WHERE n.norm=? "
+                         "ORDER BY c.released DESC LIMIT 1", (norm,))
+
+    def fuzzy(self, name: str, min_score: float = 0.5) -> Optional[dict]:
+        norm = normalize_name(name)
+        if not norm:
+            return None
+        hit = self.by_norm(norm)
+        if hit is not None:
+            return hit
+        with self._lock:
+            if self._trigram_index is None:
+                idx: dict = {}
+                for (nm,) in self._db().execute("SELECT DISTINCT norm FROM names"):
+                    for g in _trigrams(nm):
+                        idx.setdefault(g, []).append(nm)
+                self._trigram_index = idx
+        q = _trigrams(norm)
+        shared = Counter()
+        for g in q:
+            shared.update(self._trigram_index.get(g, ()))
+        best, best_score = None, min_score
+        for cand, k in shared.items():
+            score = 2.0 * k / (len(q) + len(_trigrams(cand)))
+            if score > best_score:
+                best, best_score = cand, score
+        return self.by_norm(best) if best else None
+
+BULK_INDEX: Optional[ScryfallBulkIndex] = None
 
 def scryfall_get_by_id(sid: str) -> Optional[dict]:
+    if BULK_INDEX is not None:
+        return BULK_INDEX.by_id(sid)
+    if cache_get(f"neg_scry_{sid}", CACHE_TTL["negative"]) is not None:
+        METRICS.cache_event("scryfall", "negative")
+        return None
     key = f"scry_{sid}"
-    data = cache_get(key)
-    if data is None:
-        url = SCRYFALL_ID_URL.format(id=sid)
-        r = requests.get(url, timeout=20)
-        if r.status_code != 200:
-            return None
-        data = r.json()
-        cache_set(key, data)
+    entry = get_cache().get_entry(key)
+    if entry is not None and entry.fresh(CACHE_TTL["scryfall"]):
+        METRICS.cache_event("scryfall", "hit")
+        return entry.data
+    url = SCRYFALL_ID_URL.format(id=sid)
+    r = http_get("scryfall", url, timeout=20, headers=revalidation_headers(entry))
+    if r.status_code == 304 and entry is not None:
+        METRICS.cache_event("scryfall", "revalidated")
+        get_cache().touch(key)
+        return entry.data
+    METRICS.cache_event("scryfall", "miss")
+    if r.status_code != 200:
+        if entry is None and is_definite_miss(r.status_code):
+            cache_negative(f"neg_scry_{sid}", f"http_{r.status_code}")
+        return entry.data if entry is not None else None  # stale beats nothing
+    data = r.json()
+    cache_set(key, data, r.headers.get("ETag"), r.headers.get("Last-Modified"))
     return data
 
+def named_key(name: str, set_code: Optional[str]) -> str:
+    return f"scry_named_{normalize_name(name)}|{(set_code or '').lower()}"
+
+def cached_resolve(name: str, set_code: Optional[str]) -> Tuple[bool, Optional[dict]]:
+    """
+    (hit, card) from the name -> card index that scryfall_resolve keeps.
+    A hit with card None is a cached failure.
+    """
+    idx = cache_lookup(named_key(name, set_code), CACHE_TTL["scryfall"])
+    card = None
+    if idx is not None and not idx.get("negative"):
+        card = cache_get(f"scry_{idx['id']}", CACHE_TTL["scryfall"])
+    hit = idx is not None and (idx.get("negative") or card is not None)
+    METRICS.cache_event("scryfall", "miss" if not hit else "negative" if card is None else "hit")
+    return hit, card
+
+def remember_resolve(name: str, set_code: Optional[str], card: Optional[dict], reason: str = "not_found") -> None:
+    if card is None:
+        cache_negative(named_key(name, set_code), reason)
+    else:
+        cache_set(f"scry_{card['id']}", card)
+        cache_set(named_key(name, set_code), {"id": card["id"]})
+
 def scryfall_resolve(name: str, set_code: Optional[str]) -> Optional[dict]:
+    if BULK_INDEX is not None:
+        return ((set_code and BULK_INDEX.by_name(name, set_code))
+                or BULK_INDEX.by_name(name)
+                or BULK_INDEX.fuzzy(name))
+    hit, card = cached_resolve(name, set_code)
+    if hit:
+        return card
     params = {"exact": name}
     if set_code:
         params["set"] = set_code
-    r = requests.get(SCRYFALL_NAMED_URL, params=params, timeout=20)
-    if r.status_code == 200:
-        return r.json()
-    r = requests.get(SCRYFALL_NAMED_URL, params={"exact": name}, timeout=20)
-    if r.status_code == 200:
-        return r.json()
-    r = requests.get(SCRYFALL_NAMED_URL, params={"fuzzy": name}, timeout=20)
-    if r.status_code == 200:
-        return r.json()
+    statuses = []
+    for p in (params, {"exact": name}, {"fuzzy": name}):
+        r = http_get("scryfall", SCRYFALL_NAMED_URL, params=p, timeout=20)
+        if r.status_code == 200:
+            card = r.json()
+            remember_resolve(name, set_code, card)
+            return card
+        statuses.append(r.status_code)
+    # Only cache the miss if every attempt was a real "no such card", not a 429/5xx
+    if all(is_definite_miss(st) for st in statuses):
+        remember_resolve(name, set_code, None, f"http_{statuses[-1]}")
     return None
 
-def parse_usage_from_html(html: str):
-    """Return (pct, numerator, denominator) from EDHREC card page HTML."""
-    soup = BeautifulSoup(html, "html.parser")
+def scryfall_fuzzy(name: str) -> Tuple[Optional[dict], int]:
+    r = http_get("scryfall", SCRYFALL_NAMED_URL, params={"fuzzy": name}, timeout=20)
+    if r.status_code == 200:
+        return r.json(), r.status_code
+    return None, r.status_code
 
-    # Grab all text nodes that mention "deck"
-    texts = [t for t in soup.stripped_strings if "deck" in t.lower()]
-    combined = " ".join(texts)
+def scryfall_collection(identifiers: List[dict]) -> Tuple[List[Optional[dict]], bool]:
+    """
+    POST up to SCRYFALL_COLLECTION_MAX identifiers to /cards/collection.
+    Returns one entry per identifier (the card, or None if Scryfall didn't find it), and
+    whether the request succeeded; a failed request counts as "not found" for the whole batch.
+    """
+    r = http_post("scryfall", SCRYFALL_COLLECTION_URL, json={"identifiers": identifiers}, timeout=30)
+    if r.status_code != 200:
+        return [None] * len(identifiers), False
+    body = r.json()
+    # `data` holds the found cards in request order, skipping anything listed in `not_found`
+    missing = [{k: str(v).lower() for k, v in ident.items()} for ident in body.get("not_found") or []]
+    found = iter(body.get("data") or [])
+    out: List[Optional[dict]] = []
+    for ident in identifiers:
+        norm = {k: str(v).lower() for k, v in ident.items()}
+        if norm in missing:
+            missing.remove(norm)
+            out.append(None)
+        else:
+            out.append(next(found, None))
+    return out, True
+
+def _collection_round(identifiers: List[dict], verbose: bool) -> Tuple[List[Optional[dict]], List[bool]]:
+    """Cards for any number of identifiers, plus per identifier whether its request went through."""
+    out: List[Optional[dict]] = []
+    ok: List[bool] = []
+    for i in range(0, len(identifiers), SCRYFALL_COLLECTION_MAX):
+        chunk = identifiers[i:i + SCRYFALL_COLLECTION_MAX]
+        log(f"[scryfall] POST /cards/collection ({len(chunk)} identifiers)", verbose)
+        cards, chunk_ok = scryfall_collection(chunk)
+        out.extend(cards)
+        ok.extend([chunk_ok] * len(chunk))
+    return out, ok
+
+def scryfall_resolve_batch(rows: List[CardRow], verbose: bool) -> List[Tuple[Optional[dict], bool]]:
+    """
+    Batch counterpart of scryfall_get_by_id + scryfall_resolve for a whole inventory.
+    Returns (card or None, id_lookup_failed) per row, in row order.
+
+    Rows are resolved in rounds through /cards/collection: by Scryfall ID (cached ones
+    skip the network), then by name+set, then by name alone. Only what is still
+    unresolved after that goes one-by-one to the fuzzy /cards/named endpoint.
+    Results, including definite misses, land in the same cache entries scryfall_get_by_id
+    and scryfall_resolve use, so a rerun only asks about names it hasn't seen.
+    """
+    if BULK_INDEX is not None:
+        # Everything is local already; nothing to batch
+        out = []
+        for row in rows:
+            card = scryfall_get_by_id(row.scryfall_id) if row.scryfall_id else None
+            failed = bool(row.scryfall_id) and card is None
+            out.append((card or scryfall_resolve(row.name, row.set_code), failed))
+        return out
+
+    results: List[Optional[dict]] = [None] * len(rows)
+    id_failed = [False] * len(rows)
+    unsure = [False] * len(rows)  # some request for this row failed, so a miss isn't definite
+
+    def run_round(keyed: dict, make_ident):
+        # keyed: identifier key -> row indices (identical identifiers are only sent once)
+        keys = list(keyed)
+        cards, ok = _collection_round([make_ident(k) for k in keys], verbose)
+        for k, card, k_ok in zip(keys, cards, ok):
+            for i in keyed[k]:
+                if card is not None:
+                    results[i] = card
+                elif not k_ok:
+                    unsure[i] = True
+        return dict(zip(keys, ok))
+
+    # Round 1: by ID
+    by_id: dict = {}
+    for i, row in enumerate(rows):
+        if not row.scryfall_id:
+            continue
+        if cache_get(f"neg_scry_{row.scryfall_id}", CACHE_TTL["negative"]) is not None:
+            METRICS.cache_event("scryfall", "negative")
+            id_failed[i] = True
+            continue
+        cached = cache_get(f"scry_{row.scryfall_id}", CACHE_TTL["scryfall"])
+        METRICS.cache_event("scryfall", "miss" if cached is None else "hit")
+        if cached is not None:
+            results[i] = cached
+        else:
+            by_id.setdefault(row.scryfall_id, []).append(i)
+    id_ok = run_round(by_id, lambda sid: {"id": sid})
+    for sid, ids in by_id.items():
+        for i in ids:
+            if results[i] is None:
+                id_failed[i] = True
+            else:
+                cache_set(f"scry_{sid}", results[i])
+        if results[ids[0]] is None and id_ok[sid]:
+            cache_negative(f"neg_scry_{sid}", "not_found")
+
+    # Names resolved (or definitely not found) on an earlier run
+    by_name_rows = []
+    for i, row in enumerate(rows):
+        if results[i] is None:
+            hit, card = cached_resolve(row.name, row.set_code)
+            if hit:
+                results[i] = card
+            else:
+                by_name_rows.append(i)
+
+    # Round 2: exact name + set
+    by_name_set: dict = {}
+    for i in by_name_rows:
+        if rows[i].set_code:
+            by_name_set.setdefault((rows[i].name.lower(), rows[i].set_code.lower()), []).append(i)
+    run_round(by_name_set, lambda k: {"name": k[0], "set": k[1]})
+
+    # Round 3: exact name, any printing
+    by_name: dict = {}
+    for i in by_name_rows:
+        if results[i] is None:
+            by_name.setdefault(rows[i].name.lower(), []).append(i)
+    run_round(by_name, lambda n: {"name": n})
+
+    # Leftovers: fuzzy, one request per distinct name
+    fuzzy: dict = {}
+    for i in by_name_rows:
+        if results[i] is None:
+            fuzzy.setdefault(rows[i].name.lower(), []).append(i)
+    for idxs in fuzzy.values():
+        card, status = scryfall_fuzzy(rows[idxs[0]].name)
+        for i in idxs:
+            results[i] = card
+            if card is None and not is_definite_miss(status):
+                unsure[i] = True
+
+    for i in by_name_rows:
+        if results[i] is not None or not unsure[i]:
+            remember_resolve(rows[i].name, rows[i].set_code, results[i])
+
+    resolved = sum(1 for c in results if c is not None)
+    log(f"[scryfall] Batch resolved {resolved}/{len(rows)} rows ({len(fuzzy)} fuzzy lookups)", verbose)
+    return list(zip(results, id_failed))
+
+# Bump whenever parse_usage_from_html changes what it returns; invalidates cached usage_<slug> tuples
+USAGE_PARSER_VERSION = 2
+
+_USAGE_PCT_RE = re.compile(r"([0-9]+(?:\.[0-9]+)?)\s*%\s*of\s*([0-9,]+)\s*decks", re.IGNORECASE)
+_USAGE_NUM_RE = re.compile(r"In\s+([0-9,]+)\s+decks", re.IGNORECASE)
+# Markup whose text BeautifulSoup's stripped_strings skips: script/style bodies, comments, doctype/PIs
+_NON_TEXT_RE = re.compile(r"<(script|style|template)\b[^>]*>.*?</\1\s*>|<!--.*?-->|<[!?][^>]*>", re.IGNORECASE | re.DOTALL)
+# A tag (quoted attribute values may contain ">"), or the "<>" left where _NON_TEXT_RE cut something out
+_TAG_RE = re.compile(r"</?[A-Za-z][^\s/>]*(?:[^>\"']|\"[^\"]*\"|'[^']*')*>|<>")
+
+def _usage_from_texts(texts: List[str]):
+    """Run the usage regexes over the text nodes that mention "deck"."""
+    combined = " ".join(t for t in texts if "deck" in t.lower())
 
     pct = None
     num = None
     denom = None
 
     # Look for patterns like "0.09% of 6886184 decks"
-    m = re.search(r"([0-9]+(?:\.[0-9]+)?)\s*%\s*of\s*([0-9,]+)\s*decks", combined, re.IGNORECASE)
+    m = _USAGE_PCT_RE.search(combined)
     if m:
         try:
             pct = float(m.group(1))
@@ -193,46 +1073,161 @@ def parse_usage_from_html(html: str):
             pass
 
     # Look for patterns like "In 6365 decks"
-    m2 = re.search(r"In\s+([0-9,]+)\s+decks", combined, re.IGNORECASE)
+    m2 = _USAGE_NUM_RE.search(combined)
     if m2:
         try:
             num = int(m2.group(1).replace(",", ""))
         except:
             pass
 
+    return (pct, num, denom), combined
+
+def parse_usage_from_html_fast(html: str):
+    """
+    Regex-only equivalent of the BeautifulSoup path: drop non-text markup, split the rest
+    on tags, unescape entities and strip each text node. Returns None if it found nothing,
+    so the caller can fall back to the full parser.
+    """
+    if "deck" not in html and "Deck" not in html and "DECK" not in html:
+        return None
+    cleaned = _NON_TEXT_RE.sub("<>", html)
+    texts = [t for t in (unescape(p).strip() for p in _TAG_RE.split(cleaned)) if t]
+    usage, _ = _usage_from_texts(texts)
+    return usage if usage != (None, None, None) else None
+
+def parse_usage_from_html_bs4(html: str):
+    """Return (pct, numerator, denominator) from EDHREC card page HTML via a full BeautifulSoup parse."""
+    soup = BeautifulSoup(html, "html.parser")
+
+    # Grab all text nodes that mention "deck"
+    usage, combined = _usage_from_texts(list(soup.stripped_strings))
+
     # Debug logging if nothing found
-    if pct is None and num is None and denom is None:
+    if usage == (None, None, None):
         print("[debug] parse_usage_from_html failed. Snippet:", combined[:200])
 
-    return pct, num, denom
+    return usage
+
+def parse_usage_from_html(html: str):
+    """Return (pct, numerator, denominator) from EDHREC card page HTML."""
+    usage = parse_usage_from_html_fast(html)
+    if usage is None:
+        usage = parse_usage_from_html_bs4(html)
+    return usage
+
+def resolve_edhrec_slug(card_name: str) -> Tuple[Optional[str], bool]:
+    """
+    (slug, known) for a card name. `known` slugs come from the slug index in the cache
+    (learned from earlier redirects) or the --edhrec_sitemap dump; otherwise the slug is
+    slugify_card_name's guess. A cached "no such page" result comes back as (None, True).
+    """
+    idx = cache_lookup(f"slug_{normalize_name(card_name)}", float("inf"))
+    if idx is not None:
+        return idx.get("slug"), True
+    if EDHREC_SITEMAP_SLUGS:
+        for cand in slug_candidates(card_name):
+            if cand in EDHREC_SITEMAP_SLUGS:
+                if cand != slugify_card_name(card_name):
+                    remember_slug(card_name, cand)  # later runs may not pass the sitemap
+                return cand, True
+    return slugify_card_name(card_name), False
+
+def remember_slug(card_name: str, slug: Optional[str], reason: str = "") -> None:
+    """Record the card's real slug, or (slug None) that it has no EDHREC page and why."""
+    if slug is None:
+        cache_negative(f"slug_{normalize_name(card_name)}", reason)
+    else:
+        cache_set(f"slug_{normalize_name(card_name)}", {"slug": slug})
+
+def _edhrec_route_url(edhrec_uri: str) -> str:
+    # Scryfall's related_uris.edhrec always points at edhrec.com; honour a BULKSIFTER_EDHREC_BASE override
+    if edhrec_uri.startswith("https://edhrec.com"):
+        return EDHREC_BASE + edhrec_uri[len("https://edhrec.com"):]
+    return edhrec_uri
+
+def fetch_edhrec_page(card_name: str, verbose: bool,
+                      edhrec_uri: Optional[str] = None) -> Tuple[Optional[str], Optional[tuple], Optional[str]]:
+    """
+    Network/cache half of fetch_edhrec_usage.
+    Returns (slug, usage, html): `usage` is set when a current derived tuple was cached,
+    otherwise `html` is the page still to be parsed (None if there is no page).
+
+    A guessed slug that 404s is retried once through the card's EDHREC route URL from
+    Scryfall (related_uris.edhrec), which redirects to the real card page; the slug it lands
+    on is remembered in the slug index, as is a card with no page at all, so neither costs
+    a 404 round trip again.
+    """
+    slug, known = resolve_edhrec_slug(card_name)
+    if slug is None:
+        METRICS.cache_event("edhrec", "negative")
+        log(f"[edhrec] No EDHREC page for {card_name} (cached)", verbose)
+        return None, None, None
 
+    # Derived layer: the parsed tuple, so warm runs never re-parse HTML.
+    # Entries written by an older parser version are ignored and re-derived from the cached page.
+    derived = cache_get(f"usage_{slug}", CACHE_TTL["edhrec"])
+    if derived is not None and derived.get("v") == USAGE_PARSER_VERSION:
+        METRICS.cache_event("edhrec", "hit")
+        return slug, (derived.get("pct"), derived.get("num"), derived.get("denom")), None
 
-def fetch_edhrec_usage(card_name: str, sleep: float, verbose: bool) -> Tuple[Optional[float], Optional[int], Optional[int]]:
-    slug = slugify_card_name(card_name)
     key = f"card_html_{slug}"
-    data = cache_get(key)
+    entry = get_cache().get_entry(key)
     html = None
-    if data is None:
+    if entry is not None and entry.fresh(CACHE_TTL["edhrec"]):
+        METRICS.cache_event("edhrec", "hit")
+        html = entry.data.get("html")
+    else:
         url = EDHREC_CARD_URL.format(slug=slug)
         headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"}
-        log(f"[edhrec] GET {url}", verbose)
-        r = requests.get(url, timeout=25, headers=headers)
-        if r.status_code != 200:
+        headers.update(revalidation_headers(entry))
+        log(f"[edhrec] GET {url}" + (" (revalidate)" if entry is not None else ""), verbose)
+        r = http_get("edhrec", url, timeout=25, headers=headers)
+        if r.status_code == 404 and entry is None and not known and edhrec_uri:
+            url = _edhrec_route_url(edhrec_uri)
+            log(f"[edhrec] {slug} not found, following {url}", verbose)
+            r = http_get("edhrec", url, timeout=25, headers=headers)
+            m = re.search(r"/cards/([a-z0-9-]+)/?$", urlparse(r.url).path)
+            if r.status_code == 200 and not m:
+                # The route landed somewhere other than a card page (e.g. search results)
+                log(f"[edhrec] No card page for {card_name} (route went to {r.url})", verbose)
+                remember_slug(card_name, None, "route_no_card")
+                return None, None, None
+            if m:
+                slug, key = m.group(1), f"card_html_{m.group(1)}"
+                if r.status_code == 200:
+                    remember_slug(card_name, slug)
+        METRICS.cache_event("edhrec", "revalidated" if r.status_code == 304 and entry is not None else "miss")
+        if r.status_code == 304 and entry is not None:
+            get_cache().touch(key)
+            html = entry.data.get("html")
+        elif r.status_code == 200:
+            html = r.text
+            cache_set(key, {"html": html}, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+        else:
             log(f"[edhrec] HTTP {r.status_code} for {card_name}", verbose)
-            return None, None, None
-        html = r.text
-        cache_set(key, {"html": html})
-        time.sleep(sleep)
-    else:
-        html = data.get("html")
+            if entry is None:
+                if is_definite_miss(r.status_code):
+                    remember_slug(card_name, None, f"http_{r.status_code}")
+                return slug, None, None
+            html = entry.data.get("html")  # serve the stale page rather than nothing
 
-    if not html:
-        return None, None, None
+    return slug, None, html or None
+
+def store_usage(slug: str, usage: tuple) -> None:
+    pct, num, denom = usage
+    cache_set(f"usage_{slug}", {"v": USAGE_PARSER_VERSION, "pct": pct, "num": num, "denom": denom})
 
-    pct, num, denom = parse_usage_from_html(html)
-    if pct is None and num is None and denom is None:
+def fetch_edhrec_usage(card_name: str, verbose: bool,
+                       edhrec_uri: Optional[str] = None) -> Tuple[Optional[float], Optional[int], Optional[int]]:
+    slug, usage, html = fetch_edhrec_page(card_name, verbose, edhrec_uri)
+    if usage is None:
+        if not html:
+            return None, None, None
+        usage = parse_usage_from_html(html)
+        store_usage(slug, usage)
+    if usage == (None, None, None):
         log("  ! usage stats not found", verbose)
-    return pct, num, denom
+    return usage
 
 def to_row_dict(e: Enriched) -> dict:
     return {
@@ -244,128 +1239,571 @@ def to_row_dict(e: Enriched) -> dict:
         "edh_usage_rate": e.edh_usage_rate,
         "edh_num_decks": e.edh_num_decks,
         "edh_total_decks": e.edh_total_decks,
-        "top10_by_pct": e.notes.find("[TOP10_PCT]") != -1,
-        "top10_by_num": e.notes.find("[TOP10_NUM]") != -1,
-        "highlight": e.notes.find("[HIGHLIGHT]") != -1,
-        "notes": e.notes.replace("[TOP10_PCT]","").replace("[TOP10_NUM]","").replace("[HIGHLIGHT]","").strip()
+        "top10_by_pct": e.top10_by_pct,
+        "top10_by_num": e.top10_by_num,
+        "highlight": e.highlight,
+        "notes": e.notes,
+        "scryfall_id": e.scryfall_id,
+        "inventory_key": e.inventory_key,
     }
 
-def write_partial_csv(outp: str, rows: List[Enriched], sort: bool, verbose: bool):
-    df = pd.DataFrame([to_row_dict(e) for e in rows])
-    if sort and not df.empty:
-        df = df.sort_values(by=["edh_usage_pct","edh_num_decks"], ascending=[False, False], na_position="last")
-    df.to_csv(outp, index=False)
-    log(f"[write] {len(df)} rows -> {outp}", verbose)
+OUTPUT_COLUMNS = list(to_row_dict(Enriched("", None, 0, "", None, None, None, None, "")))
+# Column types for Parquet output; nullable so missing EDHREC stats stay missing instead of NaN floats
+OUTPUT_DTYPES = {
+    "name": "string", "set": "string", "qty": "Int64", "color_identity": "string",
+    "edh_usage_pct": "Float64", "edh_usage_rate": "Float64",
+    "edh_num_decks": "Int64", "edh_total_decks": "Int64",
+    "top10_by_pct": "boolean", "top10_by_num": "boolean", "highlight": "boolean",
+    "notes": "string", "scryfall_id": "string", "inventory_key": "string",
+}
+
+def write_ranking(ranked: pd.DataFrame, path: str) -> None:
+    """Write the ranked table as CSV, or as typed Parquet when `path` ends in .parquet."""
+    if is_parquet(path):
+        require_pyarrow()
+        ranked.astype(OUTPUT_DTYPES).to_parquet(path, index=False, engine="pyarrow")
+    else:
+        ranked.to_csv(path, index=False)
+
+def flag_top_decile(ranked: pd.DataFrame) -> pd.DataFrame:
+    """Set top10_by_pct / top10_by_num / highlight from the exact 90th percentiles of the ranked table."""
+    for col, flag in (("edh_usage_pct", "top10_by_pct"), ("edh_num_decks", "top10_by_num")):
+        vals = pd.to_numeric(ranked[col], errors="coerce")
+        ranked[flag] = (vals >= vals.quantile(0.9)) if vals.notna().any() else False
+    ranked["highlight"] = ranked["top10_by_pct"] | ranked["top10_by_num"]
+    return ranked
+
+def file_sha1(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def journal_path(input_sha1: str) -> str:
+    return os.path.join(CACHE_DIR, "runs", f"{input_sha1}.jsonl")
+
+class RunJournal:
+    """
+    Append-only JSONL journal of finished rows for one input file, stored under
+    CACHE_DIR/runs/<input sha1>.jsonl. The first line is a header naming the input;
+    every other line is {"row": <index into the inventory>, ...Enriched fields}.
+
+    Each flush writes only the rows added since the previous one, so checkpointing costs
+    O(new rows) instead of rewriting the whole ranked CSV. With resume=True an existing
+    journal is kept (minus any half-written last line) and `done` holds the row indices
+    already in it; otherwise the journal starts over.
+    """
+    def __init__(self, path: str, input_sha1: str, resume: bool = False):
+        self.path = path
+        self.done: set = set()
+        self._pending: List[Tuple[int, Enriched]] = []
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if resume and os.path.exists(path):
+            self.done = {i for i, _ in read_journal(path)}
+            self._trim_torn_tail()
+            self._f = open(path, "a", encoding="utf-8")
+        else:
+            self._f = open(path, "w", encoding="utf-8")
+            self._f.write(json.dumps({"journal": 1, "input_sha1": input_sha1}) + "\n")
+        self.written = len(self.done)
+
+    def _trim_torn_tail(self):
+        # A run killed mid-write can leave a partial last line; cut back to the last newline
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def add(self, row_idx: int, e: Enriched):
+        self._pending.append((row_idx, e))
+
+    def flush(self) -> int:
+        n = len(self._pending)
+        for i, e in self._pending:
+            self._f.write(json.dumps({"row": i, **asdict(e)}, separators=(",", ":")) + "\n")
+        self._f.flush()
+        self._pending.clear()
+        self.written += n
+        return n
+
+    def close(self):
+        self.flush()
+        self._f.close()
+
+def read_journal(path: str) -> List[Tuple[int, Enriched]]:
+    """(row index, Enriched) for every complete row line in the journal, ordered by row index."""
+    rows: List[Tuple[int, Enriched]] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # torn last line
+            if "row" in rec:
+                i = rec.pop("row")
+                rows.append((i, Enriched(**rec)))
+    rows.sort(key=lambda t: t[0])
+    return rows
+
+@dataclass
+class Fetched:
+    """A row after the fetch stage: Scryfall resolved, EDHREC page (or cached usage) in hand."""
+    row: CardRow
+    scry: Optional[dict]
+    notes: List[str]
+    slug: Optional[str] = None
+    usage: Optional[tuple] = None    # (pct, num, denom) once known
+    html: Optional[str] = None       # page still waiting for the parse stage
+    parsed: bool = False             # usage came from parsing html (so it should be cached)
+    parse_s: Optional[float] = None  # time parse_stage spent (it may run in another process)
+
+def fetch_stage(row: CardRow, processed: int, total_cards: int, verbose: bool,
+                resolved: Optional[Tuple[Optional[dict], bool]] = None) -> Fetched:
+    """
+    Resolve one inventory row via Scryfall and fetch its EDHREC page (I/O only, no parsing).
+    `resolved` is this row's entry from scryfall_resolve_batch, if it was batch-resolved.
+    """
+    log(f"\n[card {processed}/{total_cards}] {row.name} (set={row.set_code or '-'}, qty={row.qty})", verbose)
+
+    notes = []
+    # Resolve via Scryfall for canonical name & colors
+    scry = None
+    if resolved is not None:
+        scry, id_failed = resolved
+        if id_failed:
+            notes.append("scryfall_id_lookup_failed")
+    else:
+        with METRICS.timed("resolve"):
+            if row.scryfall_id:
+                log(f"  - Scryfall by ID: {row.scryfall_id}", verbose)
+                scry = scryfall_get_by_id(row.scryfall_id)
+                if scry is None:
+                    notes.append("scryfall_id_lookup_failed")
+            if scry is None:
+                log(f"  - Scryfall resolve: name='{row.name}', set='{row.set_code or ''}'", verbose)
+                scry = scryfall_resolve(row.name, row.set_code)
+    if scry is None:
+        log("  ! Scryfall resolution failed", verbose)
+        return Fetched(row, None, notes)
+
+    edhrec_uri = (scry.get("related_uris") or {}).get("edhrec")
+    with METRICS.timed("fetch"):
+        slug, usage, html = fetch_edhrec_page(scry.get("name", row.name), verbose, edhrec_uri)
+    return Fetched(row, scry, notes, slug, usage, html)
+
+def parse_stage(f: Fetched) -> Fetched:
+    if f.usage is None and f.html:
+        t = time.perf_counter()
+        f.usage = parse_usage_from_html(f.html)
+        f.parse_s = time.perf_counter() - t
+        f.parsed = True
+    f.html = None
+    return f
+
+def assemble_enriched(f: Fetched, verbose: bool) -> Enriched:
+    """Final stage: cache a freshly parsed tuple and build the output row."""
+    row, scry, notes = f.row, f.scry, list(f.notes)
+    if f.parse_s is not None:
+        METRICS.observe("parse", f.parse_s)
+    if scry is None:
+        return Enriched(
+            name=row.name, set_code=row.set_code, qty=row.qty,
+            color_identity="unknown", edh_usage_pct=None, edh_usage_rate=None,
+            edh_num_decks=None, edh_total_decks=None,
+            notes="scryfall_resolve_failed"
+        )
+
+    ci = "".join([c.lower() for c in (scry.get("color_identity") or [])]) or "colorless"
+    log(f"  - color_identity: {ci}", verbose)
+
+    if f.parsed:
+        store_usage(f.slug, f.usage)
+    if f.usage == (None, None, None):
+        log("  ! usage stats not found", verbose)
+    pct, num, denom = f.usage or (None, None, None)
+    if pct is None:
+        notes.append("no_edhrec_usage_pct")
+        log("  ! edh_usage_pct not found", verbose)
+    else:
+        log(f"  - edh_usage_pct: {pct:.4f}%", verbose)
+    if num is None:
+        notes.append("no_edh_num_decks")
+    else:
+        log(f"  - edh_num_decks: {num}", verbose)
+    if denom is None:
+        notes.append("no_edh_total_decks")
+    else:
+        log(f"  - edh_total_decks: {denom}", verbose)
+
+    rate = (pct/100.0) if pct is not None else None
+
+    e = Enriched(
+        name=scry.get("name", row.name),
+        set_code=scry.get("set") or row.set_code,
+        qty=row.qty,
+        color_identity=ci,
+        edh_usage_pct=pct,
+        edh_usage_rate=rate,
+        edh_num_decks=num,
+        edh_total_decks=denom,
+        notes=";".join(notes) if notes else "",
+        scryfall_id=scry.get("id"),
+    )
+    return e
+
+def enrich_row(row: CardRow, processed: int, total_cards: int, verbose: bool,
+               resolved: Optional[Tuple[Optional[dict], bool]] = None) -> Enriched:
+    """Resolve one inventory row via Scryfall and attach its EDHREC usage stats (all three stages inline)."""
+    f = parse_stage(fetch_stage(row, processed, total_cards, verbose, resolved))
+    return assemble_enriched(f, verbose)
+
+def _iter_pipelined(rows: List[CardRow], resolved: list, concurrency: int, parse_workers: int,
+                    verbose: bool) -> Iterator[Enriched]:
+    """
+    fetch -> parse -> assemble with the stages overlapped: fetches run on a thread pool,
+    HTML parsing on a process pool (so it isn't serialized on the GIL), and assembly plus
+    cache writes on the calling thread, in input order. At most `window` rows are in
+    flight, which bounds memory held by fetched-but-unparsed pages.
+
+    Parse workers are spawned, not forked: the pool starts from a fetch thread's callback,
+    and a forked child would inherit whatever stdout/sqlite/requests locks the other
+    fetch threads held at that moment.
+    """
+    total_cards = len(rows)
+    window = max(concurrency, parse_workers) * 4
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as fetch_pool, \
+            ProcessPoolExecutor(max_workers=parse_workers,
+                                mp_context=multiprocessing.get_context("spawn")) as parse_pool:
+
+        def submit(i: int, row: CardRow, res) -> Future:
+            out: Future = Future()
+
+            def on_parsed(pf: Future):
+                try:
+                    out.set_result(pf.result())
+                except BaseException as exc:
+                    out.set_exception(exc)
+
+            def on_fetched(ff: Future):
+                try:
+                    f = ff.result()
+                    if f.usage is None and f.html:
+                        parse_pool.submit(parse_stage, f).add_done_callback(on_parsed)
+                    else:
+                        out.set_result(f)
+                except BaseException as exc:
+                    out.set_exception(exc)
+
+            fetch_pool.submit(fetch_stage, row, i, total_cards, verbose, res).add_done_callback(on_fetched)
+            return out
+
+        pending = deque()
+        for i, (row, res) in enumerate(zip(rows, resolved), 1):
+            pending.append(submit(i, row, res))
+            if len(pending) >= window:
+                yield assemble_enriched(pending.popleft().result(), verbose)
+        while pending:
+            yield assemble_enriched(pending.popleft().result(), verbose)
+
+def iter_enriched(rows: List[CardRow], concurrency: int, verbose: bool,
+                  batch_resolve: bool = False, parse_workers: int = 0) -> Iterator[Enriched]:
+    """
+    Yield an Enriched per input row, in input order.
+    concurrency <= 1 is the original one-card-at-a-time loop; otherwise a bounded
+    thread pool keeps up to ~4x concurrency cards in flight. Either way the per-host
+    token buckets in http_request do the pacing.
+    With batch_resolve, Scryfall resolution for every row happens up front via
+    /cards/collection and the per-card work is only the EDHREC lookup.
+    parse_workers > 0 moves HTML parsing to that many processes (see _iter_pipelined).
+    """
+    total_cards = len(rows)
+    if batch_resolve:
+        with METRICS.timed("resolve_batch"):
+            resolved = scryfall_resolve_batch(rows, verbose)
+    else:
+        resolved = [None] * total_cards
+    if parse_workers > 0:
+        yield from _iter_pipelined(rows, resolved, concurrency, parse_workers, verbose)
+        return
+    if concurrency <= 1:
+        for i, (row, res) in enumerate(zip(rows, resolved), 1):
+            yield enrich_row(row, i, total_cards, verbose, res)
+        return
+
+    window = max(1, concurrency * 4)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        for i, (row, res) in enumerate(zip(rows, resolved), 1):
+            pending.append(ex.submit(enrich_row, row, i, total_cards, verbose, res))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def dedup_key(row: CardRow) -> tuple:
+    """Rows with the same key resolve to the same card: same Scryfall ID, else same normalized name + set."""
+    if row.scryfall_id:
+        return ("id", row.scryfall_id.lower())
+    return ("name", normalize_name(row.name), (row.set_code or "").lower())
+
+def row_key(row: CardRow) -> str:
+    """dedup_key() as a string, stored with each output row so --previous can match the inventory's own spelling."""
+    return "|".join(dedup_key(row))
+
+def dedup_rows(rows: List[CardRow]) -> Tuple[List[CardRow], List[int]]:
+    """Returns (first row of each distinct card, index into that list for every input row)."""
+    first: dict = {}
+    unique: List[CardRow] = []
+    owner: List[int] = []
+    for row in rows:
+        k = dedup_key(row)
+        if k not in first:
+            first[k] = len(unique)
+            unique.append(row)
+        owner.append(first[k])
+    return unique, owner
+
+def fan_out(rows: List[CardRow], owner: List[int], unique_results: Iterator[Enriched]) -> Iterator[Enriched]:
+    """
+    Expand results for the distinct cards back to one Enriched per input row, in input order,
+    each with its own qty. Rows are yielded as soon as their card's result is in.
+    """
+    results: List[Enriched] = []
+    j = 0
+    for e in unique_results:
+        results.append(e)
+        while j < len(rows) and owner[j] < len(results):
+            row, src = rows[j], results[owner[j]]
+            if src.notes == "scryfall_resolve_failed":
+                # Unresolved rows keep whatever spelling this row used
+                yield replace(src, name=row.name, set_code=row.set_code, qty=row.qty)
+            else:
+                yield replace(src, qty=row.qty)
+            j += 1
+
+def read_ranking(path: str) -> List[Enriched]:
+    """Rows of an earlier ranked output (CSV or Parquet). Flags are dropped; they get recomputed."""
+    if is_parquet(path):
+        require_pyarrow()
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path, dtype=str, keep_default_na=False, encoding=detect_encoding(path))
+    df = df.astype(object).where(df.notna(), None)
+
+    def opt(v, typ):
+        return typ(float(v)) if v not in (None, "") else None
+
+    out = []
+    for rec in df.to_dict("records"):
+        out.append(Enriched(
+            name=rec["name"], set_code=rec.get("set") or None, qty=opt(rec.get("qty"), int) or 1,
+            color_identity=rec.get("color_identity") or "unknown",
+            edh_usage_pct=opt(rec.get("edh_usage_pct"), float),
+            edh_usage_rate=opt(rec.get("edh_usage_rate"), float),
+            edh_num_decks=opt(rec.get("edh_num_decks"), int),
+            edh_total_decks=opt(rec.get("edh_total_decks"), int),
+            notes=rec.get("notes") or "",
+            scryfall_id=rec.get("scryfall_id") or None,
+            inventory_key=rec.get("inventory_key") or None,
+        ))
+    return out
+
+def usage_is_fresh(e: Enriched, prev_age: float, max_age: float) -> bool:
+    """
+    Whether a previous row's EDHREC numbers are younger than `max_age` seconds (the carry-forward
+    limit, separate from the EDHREC cache TTL so a daily run can still carry rows): judged by the
+    cached usage entry for its card, or by the age of the previous ranking if the cache has none.
+    Rows without usage numbers are never carried; re-enriching them is cheap (negative cache).
+    """
+    if e.edh_usage_pct is None and e.edh_num_decks is None:
+        return False
+    slug, _ = resolve_edhrec_slug(e.name)
+    if slug is None:
+        return False
+    entry = get_cache().get_entry(f"usage_{slug}")
+    if entry is None:
+        return prev_age < max_age
+    return entry.fresh(max_age)
+
+def plan_delta(rows: List[CardRow], prev: List[Enriched], prev_age: float,
+               max_age: float) -> Tuple[List[Optional[Enriched]], int]:
+    """
+    For each inventory row, the previous ranking's row to carry forward, or None if the row
+    has to be enriched (new to the inventory, or its EDHREC data is older than `max_age`);
+    plus how many rows matched but were stale.
+    Rows match by the inventory key the previous run stored (so DFC front faces, set names and
+    rows that fell back to another printing still match); rankings written before that column
+    existed match by Scryfall ID, else by normalized name + set (name alone if the row has no set).
+    """
+    by_key, by_id, by_name_set, by_name = {}, {}, {}, {}
+    for e in prev:
+        if e.inventory_key:
+            by_key.setdefault(e.inventory_key, e)
+        if e.scryfall_id:
+            by_id.setdefault(e.scryfall_id.lower(), e)
+        by_name_set.setdefault((normalize_name(e.name), (e.set_code or "").lower()), e)
+        by_name.setdefault(normalize_name(e.name), e)
+
+    fresh: dict = {}  # id(prev row) -> still fresh?
+    out: List[Optional[Enriched]] = []
+    stale = 0
+    for row in rows:
+        key = row_key(row)
+        e = by_key.get(key)
+        if e is None and row.scryfall_id:
+            e = by_id.get(row.scryfall_id.lower())
+        if e is None and row.set_code:
+            e = by_name_set.get((normalize_name(row.name), row.set_code.lower()))
+        elif e is None and not row.scryfall_id:
+            e = by_name.get(normalize_name(row.name))
+        if e is not None and id(e) not in fresh:
+            fresh[id(e)] = usage_is_fresh(e, prev_age, max_age)
+        if e is None or not fresh[id(e)]:
+            stale += e is not None
+            out.append(None)
+        else:
+            out.append(replace(e, qty=row.qty, inventory_key=key,
+                               top10_by_pct=False, top10_by_num=False, highlight=False))
+    return out, stale
 
 def main():
+    global BULK_INDEX, HTTP_POOL_SIZE, EDHREC_SITEMAP_SLUGS
     ap = argparse.ArgumentParser(description="Rank cards by EDHREC usage (%, numerator, denominator). Marks top 10% by % and numerator.")
-    ap.add_argument("--in", dest="inp", required=True, help="Input CSV")
-    ap.add_argument("--out", dest="outp", required=True, help="Output ranked CSV")
-    ap.add_argument("--sleep", type=float, default=0.2, help="Delay between web requests (seconds)")
-    ap.add_argument("--flush_every", type=int, default=50, help="Write partial CSV every N cards processed (0=only at end)")
+    ap.add_argument("--in", dest="inp", required=True, help="Input CSV (or .parquet, needs pyarrow)")
+    ap.add_argument("--out", dest="outp", required=True, help="Output ranked CSV (or .parquet with typed columns, needs pyarrow)")
+    ap.add_argument("--sleep", type=float, default=None,
+                    help="Deprecated: caps both hosts at one request per SLEEP seconds (use --scryfall_rps/--edhrec_rps)")
+    ap.add_argument("--flush_every", type=int, default=50, help="Append finished rows to the run journal every N cards (0=only at end)")
+    ap.add_argument("--resume", action="store_true", help="Skip rows already in this input's run journal (.cache/runs/<input sha1>.jsonl)")
+    ap.add_argument("--previous", help="Earlier ranked output: carry forward rows whose EDHREC data is still fresh, enrich only the rest")
+    ap.add_argument("--previous_max_age_hours", type=float, default=168.0,
+                    help="With --previous, re-enrich carried rows whose EDHREC data is older than this")
     ap.add_argument("--no_sort", action="store_true", help="Skip final sorting to save time")
     ap.add_argument("--quiet", action="store_true", help="Reduce console output")
+    ap.add_argument("--concurrency", type=int, default=1, help="Cards enriched in parallel (1=serial)")
+    ap.add_argument("--scryfall_rps", type=float, default=10.0, help="Max requests/second to api.scryfall.com (0=unlimited)")
+    ap.add_argument("--edhrec_rps", type=float, default=5.0, help="Max requests/second to edhrec.com (0=unlimited)")
+    ap.add_argument("--chunksize", type=int, default=50000, help="Read the input CSV this many lines at a time")
+    ap.add_argument("--no_dedup", action="store_true", help="Enrich every row separately even if the same card repeats")
+    ap.add_argument("--parse_workers", type=int, default=0,
+                    help="Parse EDHREC pages in this many processes, overlapped with fetching (0=inline, -1=one per core)")
+    ap.add_argument("--batch_resolve", action="store_true", help="Resolve all rows up front via Scryfall /cards/collection (75 per request)")
+    ap.add_argument("--scryfall_ttl_days", type=float, default=30.0, help="Refetch cached Scryfall cards older than this")
+    ap.add_argument("--edhrec_ttl_hours", type=float, default=24.0, help="Revalidate cached EDHREC pages/usage older than this")
+    ap.add_argument("--negative_ttl_hours", type=float, default=6.0,
+                    help="Retry lookups that failed (card/page not found) once cached failures are older than this")
+    ap.add_argument("--cache_max_mb", "--cache-max-mb", type=float, default=0.0,
+                    help="Evict least-recently-used cache entries beyond this size at the end of the run (0=unbounded)")
+    ap.add_argument("--edhrec_sitemap", help="Saved EDHREC sitemap (XML or URL list) used to look up card slugs")
+    ap.add_argument("--bulk_json", help="Scryfall 'default cards' bulk JSON; resolve names/IDs locally instead of via the API")
+    ap.add_argument("--metrics_json", help="Write per-stage timings, cache hit/miss and HTTP counts to this JSON file")
+    ap.add_argument("--progress", action="store_true", help="Show a live progress line on stderr (best with --quiet)")
     args = ap.parse_args()
 
     verbose = not args.quiet
     t0 = time.time()
+    if any(p and is_parquet(p) for p in (args.inp, args.outp, args.previous)):
+        require_pyarrow()  # fail now rather than after the whole run
+    if args.sleep:
+        cap = 1.0 / args.sleep
+        args.scryfall_rps = min(args.scryfall_rps, cap) if args.scryfall_rps > 0 else cap
+        args.edhrec_rps = min(args.edhrec_rps, cap) if args.edhrec_rps > 0 else cap
+    RATE_LIMITERS["scryfall"].set_rate(args.scryfall_rps)
+    RATE_LIMITERS["edhrec"].set_rate(args.edhrec_rps)
+    HTTP_POOL_SIZE = max(HTTP_POOL_SIZE, args.concurrency)
+    CACHE_TTL["scryfall"] = args.scryfall_ttl_days * 86400
+    CACHE_TTL["edhrec"] = args.edhrec_ttl_hours * 3600
+    CACHE_TTL["negative"] = args.negative_ttl_hours * 3600
+    if args.edhrec_sitemap:
+        EDHREC_SITEMAP_SLUGS = load_edhrec_sitemap(args.edhrec_sitemap)
+        log(f"[edhrec] {len(EDHREC_SITEMAP_SLUGS)} card slugs from {args.edhrec_sitemap}", verbose)
+    if args.bulk_json:
+        BULK_INDEX = ScryfallBulkIndex(args.bulk_json, verbose=verbose)
 
-    rows = read_inventory(args.inp, verbose)
-    total_cards = len(rows)
-
-    enriched: List[Enriched] = []
-    processed = 0
+    with METRICS.timed("load"):
+        rows = read_inventory(args.inp, verbose, args.chunksize)
 
-    for row in rows:
-        processed += 1
-        log(f"\n[card {processed}/{total_cards}] {row.name} (set={row.set_code or '-'}, qty={row.qty})", verbose)
-
-        notes = []
-        # Resolve via Scryfall for canonical name & colors
-        scry = None
-        if row.scryfall_id:
-            log(f"  - Scryfall by ID: {row.scryfall_id}", verbose)
-            scry = scryfall_get_by_id(row.scryfall_id)
-            if scry is None:
-                notes.append("scryfall_id_lookup_failed")
-        if scry is None:
-            log(f"  - Scryfall resolve: name='{row.name}', set='{row.set_code or ''}'", verbose)
-            scry = scryfall_resolve(row.name, row.set_code)
-        if scry is None:
-            log("  ! Scryfall resolution failed", verbose)
-            enriched.append(Enriched(
-                name=row.name, set_code=row.set_code, qty=row.qty,
-                color_identity="unknown", edh_usage_pct=None, edh_usage_rate=None,
-                edh_num_decks=None, edh_total_decks=None,
-                notes="scryfall_resolve_failed"
-            ))
-            if args.flush_every and (processed % args.flush_every == 0):
-                write_partial_csv(args.outp, enriched, sort=not args.no_sort, verbose=verbose)
-            continue
+    input_sha1 = file_sha1(args.inp)
+    journal = RunJournal(journal_path(input_sha1), input_sha1, resume=args.resume)
+    if journal.done:
+        log(f"[resume] {len(journal.done)}/{len(rows)} rows already enriched in {journal.path}", verbose)
+    row_ids = [i for i in range(len(rows)) if i not in journal.done]
+    todo = [rows[i] for i in row_ids]
+    processed = len(journal.done)
 
-        ci = "".join([c.lower() for c in (scry.get("color_identity") or [])]) or "colorless"
-        log(f"  - color_identity: {ci}", verbose)
+    if args.previous and todo:
+        with METRICS.timed("delta"):
+            plan, stale = plan_delta(todo, read_ranking(args.previous),
+                                     time.time() - os.path.getmtime(args.previous),
+                                     args.previous_max_age_hours * 3600)
+        for row_idx, e in zip(row_ids, plan):
+            if e is not None:
+                journal.add(row_idx, e)
+        keep = [k for k, e in enumerate(plan) if e is None]
+        log(f"[delta] {len(todo) - len(keep)}/{len(todo)} rows carried forward from {args.previous}; "
+            f"enriching {len(keep) - stale} new and {stale} matched but stale (older than "
+            f"{args.previous_max_age_hours:g}h, or no EDHREC numbers)", verbose)
+        processed += len(todo) - len(keep)
+        row_ids = [row_ids[k] for k in keep]
+        todo = [todo[k] for k in keep]
 
-        pct, num, denom = fetch_edhrec_usage(scry.get("name", row.name), args.sleep, verbose)
-        if pct is None:
-            notes.append("no_edhrec_usage_pct")
-            log("  ! edh_usage_pct not found", verbose)
-        else:
-            log(f"  - edh_usage_pct: {pct:.4f}%", verbose)
-        if num is None:
-            notes.append("no_edh_num_decks")
-        else:
-            log(f"  - edh_num_decks: {num}", verbose)
-        if denom is None:
-            notes.append("no_edh_total_decks")
-        else:
-            log(f"  - edh_total_decks: {denom}", verbose)
-
-        rate = (pct/100.0) if pct is not None else None
-
-        enriched.append(Enriched(
-            name=scry.get("name", row.name),
-            set_code=scry.get("set") or row.set_code,
-            qty=row.qty,
-            color_identity=ci,
-            edh_usage_pct=pct,
-            edh_usage_rate=rate,
-            edh_num_decks=num,
-            edh_total_decks=denom,
-            notes=";".join(notes) if notes else ""
-        ))
+    work_rows, owner = (todo, None) if args.no_dedup else dedup_rows(todo)
+    if owner is not None:
+        log(f"[dedup] {len(todo)} rows -> {len(work_rows)} distinct cards", verbose)
 
+    parse_workers = (os.cpu_count() or 1) if args.parse_workers < 0 else args.parse_workers
+    stream = iter_enriched(work_rows, args.concurrency, verbose,
+                           batch_resolve=args.batch_resolve, parse_workers=parse_workers)
+    if owner is not None:
+        stream = fan_out(todo, owner, stream)
+    last_progress = 0.0
+    for row_idx, e in zip(row_ids, stream):
+        processed += 1
+        METRICS.card_done()
+        journal.add(row_idx, replace(e, inventory_key=row_key(rows[row_idx])))
         if args.flush_every and (processed % args.flush_every == 0):
-            write_partial_csv(args.outp, enriched, sort=not args.no_sort, verbose=verbose)
-
-        time.sleep(args.sleep)
-
-    # Compute top 10% flags
-    df = pd.DataFrame([to_row_dict(e) for e in enriched])
-    if not df.empty:
-        # Calculate thresholds ignoring NaNs/None
-        pct_thr = df['edh_usage_pct'].dropna().quantile(0.9) if df['edh_usage_pct'].notna().any() else None
-        num_thr = df['edh_num_decks'].dropna().quantile(0.9) if df['edh_num_decks'].notna().any() else None
-        for e in enriched:
-            marks = []
-            if pct_thr is not None and e.edh_usage_pct is not None and e.edh_usage_pct >= pct_thr:
-                marks.append("[TOP10_PCT]")
-            if num_thr is not None and e.edh_num_decks is not None and e.edh_num_decks >= num_thr:
-                marks.append("[TOP10_NUM]")
-            if marks:
-                marks.append("[HIGHLIGHT]")
-            if marks:
-                e.notes = (e.notes + ";" if e.notes else "") + "".join(marks)
-
-    # Final write
-    df_final = pd.DataFrame([to_row_dict(e) for e in enriched])
-    if not args.no_sort and not df_final.empty:
-        df_final = df_final.sort_values(by=["edh_usage_pct","edh_num_decks"], ascending=[False, False], na_position="last")
-    df_final.to_csv(args.outp, index=False)
-    log(f"[write] {len(df_final)} rows -> {args.outp}", verbose)
+            with METRICS.timed("flush"):
+                n = journal.flush()
+            log(f"[checkpoint] +{n} rows ({journal.written} total) -> {journal.path}", verbose)
+        if args.progress and time.time() - last_progress >= 0.5:
+            last_progress = time.time()
+            sys.stderr.write("\r" + METRICS.progress_line(len(todo)) + " ")
+            sys.stderr.flush()
+    if args.progress:
+        sys.stderr.write("\r" + METRICS.progress_line(len(todo)) + "\n")
+    with METRICS.timed("flush"):
+        journal.close()
+
+    # Rank over everything in the journal, including rows finished by earlier (resumed) runs
+    with METRICS.timed("rank"):
+        ranked = pd.DataFrame([to_row_dict(e) for _, e in read_journal(journal.path)],
+                              columns=OUTPUT_COLUMNS)
+        flag_top_decile(ranked)
+    if not args.no_sort and not ranked.empty:
+        with METRICS.timed("sort"):
+            ranked = ranked.sort_values(by=["edh_usage_pct","edh_num_decks"], ascending=[False, False], na_position="last")
+    with METRICS.timed("write"):
+        write_ranking(ranked, args.outp)
+    log(f"[write] {len(ranked)} rows -> {args.outp}", verbose)
+    os.remove(journal.path)
+
+    if args.cache_max_mb > 0:
+        dropped = get_cache().evict(int(args.cache_max_mb * 1024 * 1024))
+        if dropped:
+            log(f"[cache] Evicted {dropped} least-recently-used entries (cap {args.cache_max_mb:g} MB)", verbose)
 
     dt = time.time() - t0
-    log(f"\n[done] Processed {len(enriched)} cards in {dt:.1f}s", verbose)
+    ratio = len(todo) / len(work_rows) if work_rows else 1.0
+    log(f"\n[done] Processed {len(ranked)} cards ({len(work_rows)} distinct, dedup ratio {ratio:.2f}x) in {dt:.1f}s", verbose)
+    if args.metrics_json:
+        report = METRICS.report()
+        report.update({"input": args.inp, "rows": len(rows), "distinct": len(work_rows),
+                       "resumed": len(journal.done)})
+        with open(args.metrics_json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        log(f"[metrics] -> {args.metrics_json}", verbose)
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,12 @@
 # script.py
 # TikTok "Top 5" spammer with tags, ledger, MoviePy v1/v2 compat
 # Layout: Subtitle at top-center, numbered list left-aligned below it, video fills bottom half
+# Usage: python script.py [--jobs N] [--backend moviepy|ffmpeg]   (N renditions rendered in parallel processes)
+#        python script.py --bench_bg CLIP   (ms/frame of the blurred-background paths)
 
-import os, re, json, hashlib, random
+import os, re, json, hashlib, random, time, argparse, subprocess, tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 from pathlib import Path
 from typing import List, Dict, Set, Optional
 from moviepy import VideoFileClip, TextClip, CompositeVideoClip, ColorClip
@@ -22,6 +26,10 @@ import numpy as np
 INPUT_ROOT = Path("videos")
 OUTPUT_DIR = Path("outputs")
 LEDGER_FILE = OUTPUT_DIR / "ledger.json"
+LEDGER_VERSION = 2   # 2 = signatures built from sampled-fingerprint media_ids
+LEDGER_LOCK = OUTPUT_DIR / "ledger.lock"
+CLAIM_STALE = 3 * 3600   # seconds before an unfinished claim is assumed to be from a killed run
+MEDIA_INDEX_FILE = OUTPUT_DIR / "media_index.json"   # path -> size/mtime, media_id, tags, probe info
 
 TIKTOK_SIZE = (1080, 1920)
 SLOTS = 5
@@ -56,6 +64,13 @@ VIDEO_BOTTOM_OFFSET = 80   # <— lift the bottom video up by this many pixels
 FONT_SIZE_MAIN = 48        # was 55; slightly smaller to reduce overlap
 LIST_MARGIN_TOP = 170      # push list a bit lower under the subtitle
 
+# Blurred background
+BG_RADIUS = 28        # Gaussian blur radius at full 1080x1920 (increase for stronger blur)
+BG_DARKEN = 0.75      # brightness multiplier so text pops
+BG_FAST = True        # blur at 1/BG_DOWNSCALE resolution and upscale (False = full-res blur, much slower)
+BG_DOWNSCALE = 8
+BG_FPS = 0            # >0: recompute the background only this many times per second, holding frames between
+
 
 # ============================================================
 # COMPAT / HELPERS
@@ -90,6 +105,11 @@ def _crop(clip, **kw):
     fn = getattr(clip, "cropped", None) or getattr(clip, "crop")
     return fn(**kw)
 
+def _fl(clip, func):
+    """Apply a time-aware transform `func(get_frame, t) -> frame` across MoviePy v1/v2."""
+    fn = getattr(clip, "transform", None) or getattr(clip, "fl")
+    return fn(func)
+
 def _with_start(clip, t):
     fn = getattr(clip, "with_start", None) or getattr(clip, "set_start")
     return fn(t)
@@ -180,6 +200,24 @@ def fast_sha1(file: Path, chunk=1024*1024) -> str:
             h.update(b)
     return h.hexdigest()
 
+FP_BLOCK = 64 * 1024   # bytes hashed at each of head / middle / tail
+
+def sampled_fingerprint(file: Path, block=FP_BLOCK) -> str:
+    """
+    Cheap content identity: file size + BLAKE2b of the head, middle and tail blocks.
+    Small files (< 3 blocks) are hashed whole.
+    """
+    size = file.stat().st_size
+    h = hashlib.blake2b(digest_size=16)
+    with file.open("rb") as f:
+        if size <= 3 * block:
+            h.update(f.read())
+        else:
+            for off in (0, (size - block) // 2, size - block):
+                f.seek(off)
+                h.update(f.read(block))
+    return f"fp:{size:x}:{h.hexdigest()}"
+
 def short_sig(s: str) -> str:
     return hashlib.sha1(s.encode("utf-8")).hexdigest()[:10]
 
@@ -229,16 +267,121 @@ def visible_title(title: str) -> str:
 # ============================================================
 # LIBRARY / LEDGER
 # ============================================================
+def clip_tags(mp4: Path) -> List[str]:
+    tags = set()
+    tags |= parse_tags_from_name(mp4.name)
+    tags |= parse_tags_from_path(mp4)
+    tags |= parse_tags_sidecar(mp4)
+    return sorted(tags)
+
+def probe_media(mp4: Path) -> Dict:
+    """Duration / resolution / audio from ffmpeg's header probe (no frames decoded)."""
+    try:
+        from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+        info = ffmpeg_parse_infos(str(mp4))
+        size = info.get("video_size")
+        return {"duration": info.get("duration"),
+                "resolution": list(size) if size else None,
+                "has_audio": bool(info.get("audio_found"))}
+    except Exception:
+        return {"duration": None, "resolution": None, "has_audio": None}
+
+# Loaded once, then kept across main() rounds of the interactive loop
+_media_index: Optional[Dict[str, Dict]] = None
+_media_index_dirty = False   # full hashes were added since the last save
+
+def load_media_index() -> Dict[str, Dict]:
+    if MEDIA_INDEX_FILE.exists():
+        try:
+            data = json.loads(MEDIA_INDEX_FILE.read_text(encoding="utf-8"))
+            return data.get("files", {})
+        except Exception:
+            return {}
+    return {}
+
+def save_media_index(index: Dict[str, Dict]):
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = MEDIA_INDEX_FILE.with_suffix(".json.tmp")
+    tmp.write_text(json.dumps({"files": index}, indent=1), encoding="utf-8")
+    os.replace(tmp, MEDIA_INDEX_FILE)
+
+def media_sha1(item: Dict) -> str:
+    """Full-file SHA-1 of a clip, computed at most once per file version and kept in the media index."""
+    global _media_index_dirty
+    ent = (_media_index or {}).get(item["path"])
+    if ent is not None and ent.get("sha1"):
+        return ent["sha1"]
+    digest = fast_sha1(Path(item["path"]))
+    if ent is not None:
+        ent["sha1"] = digest
+        _media_index_dirty = True
+    return digest
+
+def flush_media_index():
+    global _media_index_dirty
+    if _media_index_dirty and _media_index is not None:
+        save_media_index(_media_index)
+        _media_index_dirty = False
+
 def index_library() -> List[Dict]:
+    """
+    Scan INPUT_ROOT for clips. Files whose size and mtime match the media index reuse the
+    stored media_id/probe info; only new or changed files are fingerprinted and probed.
+    Tags are re-read when the .json sidecar's mtime changes.
+
+    media_id is the sampled fingerprint. When fingerprints collide, the full SHA-1 decides:
+    identical copies keep the shared id, and clips whose content differs from the oldest
+    file in the group get "sha1:<full hash>" instead (so existing ledger entries stay valid).
+    """
+    global _media_index, _media_index_dirty
+    if _media_index is None:
+        _media_index = load_media_index()
     items = []
+    current = {}
+    changed = 0
     for mp4 in INPUT_ROOT.rglob("*.mp4"):
-        name = mp4.stem
-        tags = set()
-        tags |= parse_tags_from_name(mp4.name)
-        tags |= parse_tags_from_path(mp4)
-        tags |= parse_tags_sidecar(mp4)
-        media_id = fast_sha1(mp4)
-        items.append({"path": str(mp4), "title": name, "tags": sorted(tags), "media_id": media_id})
+        st = mp4.stat()
+        js = mp4.with_suffix(".json")
+        side_mtime = js.stat().st_mtime_ns if js.exists() else None
+        key = str(mp4)
+        ent = _media_index.get(key)
+        if ent is None or ent.get("size") != st.st_size or ent.get("mtime_ns") != st.st_mtime_ns:
+            ent = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sidecar_mtime_ns": side_mtime,
+                   "fingerprint": sampled_fingerprint(mp4), "tags": clip_tags(mp4)}
+            ent.update(probe_media(mp4))
+            changed += 1
+        elif "fingerprint" not in ent:
+            # Entry from before fingerprints: its media_id is the full SHA-1
+            ent = dict(ent, sha1=ent.get("media_id"), fingerprint=sampled_fingerprint(mp4))
+            ent.pop("media_id", None)
+            changed += 1
+        if ent.get("sidecar_mtime_ns") != side_mtime:
+            ent = dict(ent, sidecar_mtime_ns=side_mtime, tags=clip_tags(mp4))
+            changed += 1
+        current[key] = ent
+        items.append({"path": key, "title": mp4.stem, "tags": ent["tags"],
+                      "media_id": ent["fingerprint"], "fingerprint": ent["fingerprint"],
+                      "duration": ent.get("duration"), "resolution": ent.get("resolution"),
+                      "has_audio": ent.get("has_audio")})
+    dropped = len(set(_media_index) - set(current))
+    _media_index = current
+
+    by_fp: Dict[str, List[Dict]] = {}
+    for it in items:
+        by_fp.setdefault(it["media_id"], []).append(it)
+    for group in by_fp.values():
+        if len(group) > 1:
+            oldest = min(group, key=lambda it: current[it["path"]]["mtime_ns"])
+            keep = media_sha1(oldest)
+            for it in group:
+                digest = media_sha1(it)
+                if digest != keep:
+                    it["media_id"] = "sha1:" + digest
+
+    if changed or dropped or _media_index_dirty:
+        save_media_index(current)
+        _media_index_dirty = False
+    print(f"Indexed {len(items)} clip(s) ({changed} new/changed).")
     return items
 
 def filter_by_tags(items: List[Dict]) -> List[Dict]:
@@ -252,18 +395,112 @@ def filter_by_tags(items: List[Dict]) -> List[Dict]:
         res.append(it)
     return res
 
-def load_ledger() -> Set[str]:
+def load_ledger() -> Dict:
+    """
+    {"signatures", "legacy", "legacy_media", "pending"}. Ledgers from before LEDGER_VERSION 2 hold
+    signatures built from full-file SHA-1 media_ids; those are kept as legacy and still honoured.
+    legacy_media is the fingerprints of the clips that existed when the ledger was migrated
+    (None until migrate_ledger has run); only orders made entirely of them can match a legacy signature.
+    pending maps signatures a run has claimed but not finished rendering to {"pid", "t"}.
+    """
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    ledger = {"signatures": set(), "legacy": set(), "legacy_media": set(), "pending": {}}
     if LEDGER_FILE.exists():
         try:
             data = json.loads(LEDGER_FILE.read_text(encoding="utf-8"))
-            return set(data.get("signatures", []))
+            sigs = set(data.get("signatures", []))
+            if data.get("version", 1) < 2:
+                ledger.update(legacy=sigs, legacy_media=None)
+                return ledger
+            legacy = set(data.get("legacy_signatures", []))
+            media = data.get("legacy_media")
+            ledger.update(signatures=sigs, legacy=legacy,
+                          legacy_media=None if media is None and legacy else set(media or []),
+                          pending=dict(data.get("pending", {})))
         except Exception:
-            return set()
-    return set()
+            pass
+    return ledger
+
+def save_ledger(ledger: Dict):
+    data = {"version": LEDGER_VERSION, "signatures": sorted(ledger["signatures"])}
+    if ledger["legacy"]:
+        data["legacy_signatures"] = sorted(ledger["legacy"])
+        if ledger["legacy_media"] is not None:
+            data["legacy_media"] = sorted(ledger["legacy_media"])
+    if ledger["pending"]:
+        data["pending"] = ledger["pending"]
+    # write-then-rename so a crash never leaves a half-written ledger
+    tmp = LEDGER_FILE.with_suffix(".json.tmp")
+    tmp.write_text(json.dumps(data, indent=2), encoding="utf-8")
+    os.replace(tmp, LEDGER_FILE)
+
+def expire_claims(ledger: Dict, stale: float = CLAIM_STALE) -> int:
+    """
+    Drop pending claims nobody has refreshed for `stale` seconds: their run was killed before it
+    could finish or release them (same rule as a stale ledger_lock file).
+    """
+    now = time.time()
+    dead = [sig for sig, c in ledger["pending"].items() if now - c.get("t", 0) > stale]
+    for sig in dead:
+        del ledger["pending"][sig]
+    return len(dead)
+
+@contextmanager
+def ledger_lock(timeout=60.0, stale=600.0):
+    """
+    Cross-process lock for ledger read-modify-write: an O_EXCL lock file (works on Windows too).
+    A lock file older than `stale` seconds is assumed to be left over from a crashed run.
+    """
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    t0 = time.time()
+    while True:
+        try:
+            fd = os.open(LEDGER_LOCK, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, str(os.getpid()).encode())
+            os.close(fd)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - LEDGER_LOCK.stat().st_mtime > stale:
+                    LEDGER_LOCK.unlink()
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.time() - t0 > timeout:
+                raise TimeoutError(f"{LEDGER_LOCK} is held by another run (delete it if none is running)")
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        try: LEDGER_LOCK.unlink()
+        except FileNotFoundError: pass
+
+def rendition_sig(order: List[Dict]) -> str:
+    return short_sig("|".join([it["media_id"] for it in order]) + "|slots=1..5")
+
+def migrate_ledger(lib: List[Dict]):
+    """
+    One-time upgrade of a ledger with legacy signatures: full-hash the current library once and
+    record which clips existed, so later rounds never full-hash clips added after the migration.
+    """
+    with ledger_lock():
+        ledger = load_ledger()
+        if not ledger["legacy"] or ledger["legacy_media"] is not None:
+            return
+        print(f"Migrating ledger: hashing {len(lib)} clip(s) once ...")
+        for it in lib:
+            media_sha1(it)
+        ledger["legacy_media"] = {it["fingerprint"] for it in lib}
+        save_ledger(ledger)
+    flush_media_index()
 
-def save_ledger(sigs: Set[str]):
-    LEDGER_FILE.write_text(json.dumps({"signatures": sorted(sigs)}, indent=2), encoding="utf-8")
+def is_legacy_order(order: List[Dict], legacy_media: Optional[Set[str]]) -> bool:
+    """True if every clip in the order predates the ledger migration (so it may match a legacy signature)."""
+    return bool(legacy_media) and all(it["fingerprint"] in legacy_media for it in order)
+
+def legacy_rendition_sig(order: List[Dict]) -> str:
+    # What rendition_sig was when media_id was the full SHA-1 (hashes only these clips, once each)
+    return short_sig("|".join([media_sha1(it) for it in order]) + "|slots=1..5")
 
 # ============================================================
 # LAYOUT
@@ -282,9 +519,50 @@ def resize_for_bottom_half(clip):
     y = int(TIKTOK_SIZE[1] - c.h - VIDEO_BOTTOM_OFFSET)
     return _with_position(c, (x, y))
 
-def make_blurred_bg(base_clip):
+def make_blurred_bg(base_clip, fast: Optional[bool] = None, bg_fps: Optional[float] = None):
+    """
+    Build a full-frame, *smoothly blurred* background from base_clip (cover-fit to 1080x1920,
+    Gaussian blur, darkened).
+
+    Fast path (BG_FAST): each frame is cropped and box-downscaled to 1/BG_DOWNSCALE in one
+    Pillow resize, blurred with the radius scaled to match and darkened through a lookup
+    table at that size, then upscaled. The result looks the same (the blur removes all the
+    detail the low resolution loses) for a fraction of the work. With bg_fps/BG_FPS > 0 the
+    background is only recomputed that often and held in between.
+    """
+    if not (BG_FAST if fast is None else fast):
+        return make_blurred_bg_full(base_clip)
+    bg_fps = BG_FPS if bg_fps is None else bg_fps
+
+    small = (TIKTOK_SIZE[0] // BG_DOWNSCALE, TIKTOK_SIZE[1] // BG_DOWNSCALE)
+    half = (TIKTOK_SIZE[0] // 2, TIKTOK_SIZE[1] // 2)
+    # Cover-fit crop box, in source pixels
+    scale = max(TIKTOK_SIZE[0] / base_clip.w, TIKTOK_SIZE[1] / base_clip.h)
+    cw, ch = TIKTOK_SIZE[0] / scale, TIKTOK_SIZE[1] / scale
+    box = ((base_clip.w - cw) / 2, (base_clip.h - ch) / 2, (base_clip.w + cw) / 2, (base_clip.h + ch) / 2)
+    blur = ImageFilter.GaussianBlur(radius=BG_RADIUS / BG_DOWNSCALE)
+    darken = [int(v * BG_DARKEN) for v in range(256)] * 3
+
+    def _bg_frame(frame):
+        img = Image.fromarray(frame).resize(small, Image.BOX, box=box)
+        img = img.filter(blur).point(darken)
+        # Bilinear to half size does the smoothing; the last 2x is nearest (invisible on a blur, ~2x cheaper)
+        img = img.resize(half, Image.BILINEAR).resize(TIKTOK_SIZE, Image.NEAREST)
+        return np.asarray(img)
+
+    held = {}
+    def _frame(get_frame, t):
+        if bg_fps and bg_fps > 0:
+            t = int(t * bg_fps) / bg_fps
+        if held.get("t") != t:
+            held["t"], held["frame"] = t, _bg_frame(get_frame(t))
+        return held["frame"]
+
+    return _fl(base_clip, _frame)
+
+def make_blurred_bg_full(base_clip):
     """
-    Build a full-frame, *smoothly blurred* background from base_clip:
+    Full-resolution reference version of make_blurred_bg:
     - Scale & center-crop to 1080x1920 (cover-fit)
     - Apply strong Gaussian blur using Pillow (no pixelation)
     - Slightly darken for readability
@@ -301,18 +579,17 @@ def make_blurred_bg(base_clip):
     )
 
     # True Gaussian blur via Pillow on every frame
-    RADIUS = 28  # increase for stronger blur (e.g., 35–40)
     def _blur_frame(frame):
-        return np.array(Image.fromarray(frame).filter(ImageFilter.GaussianBlur(radius=RADIUS)))
+        return np.array(Image.fromarray(frame).filter(ImageFilter.GaussianBlur(radius=BG_RADIUS)))
 
     blurred = _fl_image(c, _blur_frame)
 
     # Slight darken so text pops; fall back to per-frame multiply if needed
     try:
-        blurred = blurred.fx(vfx.colorx, 0.75)
+        blurred = blurred.fx(vfx.colorx, BG_DARKEN)
     except Exception:
         def _darken(frame):
-            arr = frame.astype(np.float32) * 0.75
+            arr = frame.astype(np.float32) * BG_DARKEN
             return np.clip(arr, 0, 255).astype(np.uint8)
         blurred = _fl_image(blurred, _darken)
 
@@ -325,14 +602,11 @@ from moviepy import ImageClip
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
 
-def list_panel_overlay(slots_text: List[str], start_t: float, dur: float,
-                       font_path_or_none, color_rgb, panel_rgb):
+def list_panel_image(slots_text: List[str], font_path_or_none, color_rgb) -> Image.Image:
     """
-    Transparent top-half overlay that ONLY contains the numbered list text.
-    No colored panel. Renders with Pillow into one RGBA image, then to ImageClip.
+    Transparent top-half RGBA image that ONLY contains the numbered list text (no colored panel).
+    Shared by the MoviePy overlay and the ffmpeg backend, which overlays it as a PNG.
     """
-    overlays = []
-
     w = TIKTOK_SIZE[0]
     panel_h = TIKTOK_SIZE[1] // 2
 
@@ -392,8 +666,18 @@ def list_panel_overlay(slots_text: List[str], start_t: float, dur: float,
         draw_text_right(x_num + NUM_COL_W, y_center, num_text)
         draw_text_left(x_title,            y_center, title_text)
 
+    return img
+
+def list_panel_overlay(slots_text: List[str], start_t: float, dur: float,
+                       font_path_or_none, color_rgb, panel_rgb):
+    """
+    Transparent top-half overlay that ONLY contains the numbered list text.
+    No colored panel. Renders with Pillow into one RGBA image, then to ImageClip.
+    """
+    overlays = []
+
     # Convert to a timed overlay clip
-    arr = np.array(img)  # RGBA
+    arr = np.array(list_panel_image(slots_text, font_path_or_none, color_rgb))  # RGBA
     panel_clip = ImageClip(arr)
     panel_clip = _with_duration(panel_clip, dur)
     panel_clip = _with_position(panel_clip, ("center", "top"))
@@ -414,10 +698,27 @@ def common_tag(order_items):
     if not common: return None
     return sorted(common, key=lambda s:(len(s), s))[0]
 
+def make_subtitle(order_items, font_path):
+    """'Top 5 <tag> clips' TextClip for the tag all clips share, or None."""
+    com = common_tag(order_items)
+    if not com:
+        return None
+    sub_kw = dict(
+        fontsize=FONT_SIZE_SUBTITLE,
+        color="white",
+        stroke_color="black",
+        stroke_width=5,
+        method="label",
+    )
+    if font_path:
+        sub_kw["font"] = font_path
+    return make_textclip(f"Top 5 {com} clips", **sub_kw)
+
 # ============================================================
 # RENDER
 # ============================================================
-def render_one(order_items: List[Dict], style, out_name_base: str):
+def render_one(order_items: List[Dict], style, out_name_base: str, threads: Optional[int] = None,
+               quiet: bool = False):
     font_family = style["font_family"]
     font_path = style["font_path"]
     text_rgb, panel_rgb = style["text_rgb"], style["panel_rgb"]
@@ -451,19 +752,8 @@ def render_one(order_items: List[Dict], style, out_name_base: str):
     total_dur = t if not TEST_MODE else TEST_FRAMES / FPS
 
     # Optional subtitle stays the same
-    com = common_tag(order_items)
-    subtitle_clip = None
-    if com:
-        sub_kw = dict(
-            fontsize=FONT_SIZE_SUBTITLE,
-            color="white",
-            stroke_color="black",
-            stroke_width=5,
-            method="label",
-        )
-        if font_path:
-            sub_kw["font"] = font_path
-        subtitle_clip = make_textclip(f"Top 5 {com} clips", **sub_kw)
+    subtitle_clip = make_subtitle(order_items, font_path)
+    if subtitle_clip:
         subtitle_clip = _with_position(subtitle_clip, ("center", SUBTITLE_MARGIN_TOP))
         subtitle_clip = _with_start(subtitle_clip, 0)
         subtitle_clip = _with_duration(subtitle_clip, total_dur)
@@ -478,13 +768,16 @@ def render_one(order_items: List[Dict], style, out_name_base: str):
     out_file = OUTPUT_DIR / f"{out_name_base}.mp4"
     print(f"  -> font: {font_family} ({font_path or 'PIL default'})")
 
+    write_kw = dict(fps=FPS, codec="libx264", audio_codec="aac", threads=threads)
+    if quiet:
+        write_kw["logger"] = None   # parallel renders would interleave their progress bars
     if TEST_MODE:
         test_seconds = TEST_FRAMES / FPS
         final_short = _subclip(final, 0, test_seconds)
-        final_short.write_videofile(str(out_file), fps=FPS, codec="libx264", audio_codec="aac")
+        final_short.write_videofile(str(out_file), **write_kw)
         final_short.close()
     else:
-        final.write_videofile(str(out_file), fps=FPS, codec="libx264", audio_codec="aac")
+        final.write_videofile(str(out_file), **write_kw)
 
     # Close all derivative clips
     for c in opened + bgs:
@@ -493,61 +786,272 @@ def render_one(order_items: List[Dict], style, out_name_base: str):
     final.close()
 
 
+def ffmpeg_binary() -> str:
+    """The ffmpeg MoviePy itself uses (imageio-ffmpeg's bundled one unless overridden)."""
+    try:
+        from moviepy.config import FFMPEG_BINARY        # v2
+        return FFMPEG_BINARY
+    except ImportError:
+        from moviepy.config import get_setting          # v1
+        return get_setting("FFMPEG_BINARY")
+
+def clip_rgba(clip) -> Image.Image:
+    """First frame of a (masked) clip as an RGBA image."""
+    rgb = clip.get_frame(0).astype(np.uint8)
+    if clip.mask is not None:
+        alpha = (clip.mask.get_frame(0) * 255).astype(np.uint8)
+    else:
+        alpha = np.full(rgb.shape[:2], 255, np.uint8)
+    return Image.fromarray(np.dstack([rgb, alpha]), "RGBA")
+
+def render_one_ffmpeg(order_items: List[Dict], style, out_name_base: str, threads: Optional[int] = None,
+                      quiet: bool = False):
+    """
+    Same layout as render_one, but built as one ffmpeg filter_complex graph and run as a single
+    native process. Per segment: the clip is split into a blurred background (cover-fit at
+    1/BG_DOWNSCALE, box blur, darken, upscale) and the bottom-half foreground, overlaid, then
+    topped with that segment's list PNG. Segments are concatenated and the subtitle PNG goes
+    over the whole thing. Text is still drawn by Pillow/TextClip so it looks the same.
+    """
+    font_family = style["font_family"]
+    font_path = style["font_path"]
+    W, H = TIKTOK_SIZE
+    sw, sh = W // BG_DOWNSCALE, H // BG_DOWNSCALE
+    # PIL's Gaussian is three box passes; pick the box radius giving the same sigma at the small size
+    sigma = BG_RADIUS / BG_DOWNSCALE
+    box_r = max(1, round(((12 * sigma * sigma / 3 + 1) ** 0.5 - 1) / 2))
+    fg_h = H // 2
+    fg_y = H - fg_h - VIDEO_BOTTOM_OFFSET
+    n = len(order_items)
+
+    with tempfile.TemporaryDirectory(prefix="top5_") as tmp:
+        inputs, chains, segs = [], [], []
+        for it in order_items:
+            inputs += ["-i", it["path"]]
+
+        slots_text = [""] * SLOTS
+        for i, it in enumerate(order_items):
+            slots_text[i] = visible_title(it["title"])
+            png = Path(tmp) / f"list_{i}.png"
+            list_panel_image(slots_text, font_path, style["text_rgb"]).save(png)
+            inputs += ["-i", str(png)]
+
+            has_audio, dur = it.get("has_audio"), it.get("duration")
+            if has_audio is None or dur is None:
+                info = probe_media(Path(it["path"]))
+                has_audio, dur = info["has_audio"], info["duration"]
+            if dur is None:
+                # Header probe failed; let MoviePy open it the way render_one would
+                with VideoFileClip(it["path"]) as c:
+                    dur = c.duration
+                    has_audio = c.audio is not None
+            if not dur:
+                raise RuntimeError(f"Can't determine the duration of {it['path']}")
+
+            chains += [
+                f"[{i}:v]split=2[b{i}][f{i}]",
+                f"[b{i}]scale={sw}:{sh}:force_original_aspect_ratio=increase:flags=area,crop={sw}:{sh},"
+                f"format=gbrp,boxblur={box_r}:3,"
+                f"colorchannelmixer=rr={BG_DARKEN}:gg={BG_DARKEN}:bb={BG_DARKEN},"
+                f"scale={W}:{H}:flags=bilinear[bg{i}]",
+                f"[f{i}]scale=-2:{fg_h},crop=w=min(iw\\,{W}):h=ih[fg{i}]",
+                f"[bg{i}][fg{i}]overlay=x=(W-w)/2:y={fg_y}[s{i}]",
+                f"[s{i}][{n + i}:v]overlay=0:0,fps={FPS},trim=duration={dur},setpts=PTS-STARTPTS,"
+                f"format=yuv420p,setsar=1[v{i}]",
+            ]
+            # Trim both streams to the probed duration (what MoviePy uses), or concat drifts by
+            # the audio encoder padding at every segment boundary. render_one's composite mixes each
+            # clip's track twice (from both the background and the foreground clip), so match its level.
+            if has_audio:
+                chains.append(f"[{i}:a]atrim=duration={dur},asetpts=PTS-STARTPTS,volume=2,"
+                              f"aformat=sample_rates=44100:channel_layouts=stereo[a{i}]")
+            else:
+                chains.append(f"anullsrc=r=44100:cl=stereo,atrim=duration={dur}[a{i}]")
+            segs.append(f"[v{i}][a{i}]")
+
+        chains.append("".join(segs) + f"concat=n={n}:v=1:a=1[vcat][acat]")
+        vout = "[vcat]"
+        subtitle_clip = make_subtitle(order_items, font_path)
+        if subtitle_clip:
+            png = Path(tmp) / "subtitle.png"
+            clip_rgba(subtitle_clip).save(png)
+            subtitle_clip.close()
+            inputs += ["-i", str(png)]
+            chains.append(f"[vcat][{2 * n}:v]overlay=x=(W-w)/2:y={SUBTITLE_MARGIN_TOP}[vout]")
+            vout = "[vout]"
+
+        out_file = OUTPUT_DIR / f"{out_name_base}.mp4"
+        print(f"  -> font: {font_family} ({font_path or 'PIL default'})")
+        cmd = [ffmpeg_binary(), "-y", "-hide_banner", "-loglevel", "error"]
+        if not quiet:
+            cmd.append("-stats")
+        cmd += inputs + ["-filter_complex", ";".join(chains), "-map", vout, "-map", "[acat]",
+                         "-r", str(FPS), "-c:v", "libx264", "-preset", "medium", "-pix_fmt", "yuv420p",
+                         "-c:a", "aac"]
+        if threads:
+            cmd += ["-threads", str(threads)]
+        if TEST_MODE:
+            cmd += ["-frames:v", str(TEST_FRAMES), "-t", f"{TEST_FRAMES / FPS:.3f}"]
+        cmd.append(str(out_file))
+
+        proc = subprocess.run(cmd, stderr=subprocess.PIPE if quiet else None, text=True)
+        if proc.returncode != 0:
+            err = (proc.stderr or "").strip().splitlines()[-5:]
+            raise RuntimeError(f"ffmpeg exited with {proc.returncode}: {' | '.join(err)}")
+
+RENDER_BACKENDS = {"moviepy": render_one, "ffmpeg": render_one_ffmpeg}
+
 # ============================================================
 # MAIN
 # ============================================================
-def main():
+def plan_renditions(pool: List[Dict], count: int) -> List[Dict]:
+    """
+    Pick up to `count` unused clip orders and their styles, and claim their signatures in
+    the ledger straight away (under the ledger lock), so parallel workers, or another run,
+    can never render the same one. Claims stay pending until finish_claim records the render.
+    """
+    plans = []
+    with ledger_lock():
+        ledger = load_ledger()
+        expired = expire_claims(ledger)
+        if expired:
+            print(f"Dropped {expired} stale claim(s) left by a killed run.")
+        used, legacy, pending = ledger["signatures"], ledger["legacy"], ledger["pending"]
+        attempts = 0
+        max_attempts = count * 50
+
+        while len(plans) < count and attempts < max_attempts:
+            attempts += 1
+            selection = random.sample(pool, SLOTS)
+            order = selection[:]
+            random.shuffle(order)
+
+            sig = rendition_sig(order)
+            if sig in used or sig in pending:
+                continue
+            if is_legacy_order(order, ledger["legacy_media"]) and legacy_rendition_sig(order) in legacy:
+                used.add(sig)   # made before the ledger migration; remember it under the new signature
+                continue
+
+            family = random.choice(FONT_CHOICES)
+            fpath = resolve_font_path(family)
+            panel_rgb = random_rgb()
+            text_rgb = contrasting_text_color(panel_rgb)
+
+            style = {
+                "font_family": family,
+                "font_path": fpath,
+                "text_rgb": text_rgb,
+                "panel_rgb": panel_rgb,
+            }
+
+            tag_union = sorted(set(t for it in order for t in it["tags"]))
+            tag_bucket = "+".join(tag_union[:4]) if tag_union else "untagged"
+            out_base = f"top5__{tag_bucket}__{sig}"
+
+            pending[sig] = {"pid": os.getpid(), "t": time.time()}
+            plans.append({"order": order, "style": style, "out_base": out_base, "sig": sig})
+
+        save_ledger(ledger)
+    return plans
+
+def finish_claim(sig: str):
+    """Record a finished render, and refresh this run's other claims so they don't look stale."""
+    with ledger_lock():
+        ledger = load_ledger()
+        ledger["pending"].pop(sig, None)
+        ledger["signatures"].add(sig)
+        now, pid = time.time(), os.getpid()
+        for c in ledger["pending"].values():
+            if c.get("pid") == pid:
+                c["t"] = now
+        save_ledger(ledger)
+
+def release_claims(sigs: List[str]):
+    """Give signatures back after their renders failed (or never ran), so they can be tried again."""
+    with ledger_lock():
+        ledger = load_ledger()
+        for sig in sigs:
+            ledger["pending"].pop(sig, None)
+        save_ledger(ledger)
+
+def main(jobs: int = 1, backend: str = "moviepy"):
     lib = index_library()
     if not lib: raise SystemExit("No .mp4 files found under videos/")
+    migrate_ledger(lib)
     pool = filter_by_tags(lib)
     if not pool: raise SystemExit("No videos matched tag filter.")
     if len(pool) > MAX_CLIPS_POOL:
         pool = random.sample(pool, MAX_CLIPS_POOL)
 
-    used = load_ledger()
-    made, attempts = 0, 0
-    max_attempts = NUM_RENDITIONS * 50
+    render = RENDER_BACKENDS[backend]
+    plans = plan_renditions(pool, NUM_RENDITIONS)
+    flush_media_index()
+    rendered = set()
 
-    while made < NUM_RENDITIONS and attempts < max_attempts:
-        attempts += 1
-        selection = random.sample(pool, SLOTS)
-        order = selection[:]
-        random.shuffle(order)
-
-        sig_basis = "|".join([it["media_id"] for it in order]) + "|slots=1..5"
-        sig = short_sig(sig_basis)
-        if sig in used:
-            continue
-
-        family = random.choice(FONT_CHOICES)
-        fpath = resolve_font_path(family)
-        panel_rgb = random_rgb()
-        text_rgb = contrasting_text_color(panel_rgb)
-
-        style = {
-            "font_family": family,
-            "font_path": fpath,
-            "text_rgb": text_rgb,
-            "panel_rgb": panel_rgb,
-        }
-
-
-        tag_union = sorted(set(t for it in order for t in it["tags"]))
-        tag_bucket = "+".join(tag_union[:4]) if tag_union else "untagged"
-        out_base = f"top5__{tag_bucket}__{sig}"
-
-        print(f"Rendering {out_base} ...")
-        render_one(order, style, out_base)
-
-        used.add(sig)
-        save_ledger(used)
-        made += 1
-
-    print(f"Done. Created {made} rendition(s). Ledger has {len(used)} entries.")
+    try:
+        if jobs <= 1:
+            for p in plans:
+                print(f"Rendering {p['out_base']} ...")
+                render(p["order"], p["style"], p["out_base"])
+                finish_claim(p["sig"])
+                rendered.add(p["sig"])
+        else:
+            # Split the cores between workers so their ffmpeg encoders don't oversubscribe the CPU
+            threads = max(1, (os.cpu_count() or 1) // jobs)
+            with ProcessPoolExecutor(max_workers=jobs) as ex:
+                futures = {}
+                for p in plans:
+                    print(f"Rendering {p['out_base']} ...")
+                    futures[ex.submit(render, p["order"], p["style"], p["out_base"], threads, True)] = p
+                for fut in as_completed(futures):
+                    p = futures[fut]
+                    try:
+                        fut.result()
+                        finish_claim(p["sig"])
+                        rendered.add(p["sig"])
+                        print(f"  done: {p['out_base']}")
+                    except Exception as e:
+                        print(f"  FAILED: {p['out_base']}: {e}")
+    finally:
+        unrendered = [p["sig"] for p in plans if p["sig"] not in rendered]
+        if unrendered:
+            release_claims(unrendered)
+
+    used = load_ledger()["signatures"]
+    print(f"Done. Created {len(rendered)} rendition(s). Ledger has {len(used)} entries.")
+
+def bench_background(path: str, frames: int = 30):
+    """Print ms/frame of the full-res and fast background paths (and frame decode alone) for one clip."""
+    base = VideoFileClip(path)
+    ts = [i / FPS for i in range(frames) if i / FPS < base.duration]
+    variants = [
+        ("decode only", base),
+        ("full-res blur", make_blurred_bg(base, fast=False)),
+        ("fast", make_blurred_bg(base, fast=True, bg_fps=0)),
+        ("fast @10fps", make_blurred_bg(base, fast=True, bg_fps=10)),
+    ]
+    for label, clip in variants:
+        clip.get_frame(0)   # warm up the reader
+        t0 = time.perf_counter()
+        for t in ts:
+            clip.get_frame(t)
+        dt = time.perf_counter() - t0
+        print(f"[bg] {label:>14}: {dt / len(ts) * 1000:8.1f} ms/frame  ({len(ts)} frames of {path})")
+    base.close()
 
 if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Render TikTok 'Top 5' compilations from videos/.")
+    ap.add_argument("--jobs", type=int, default=1, help="Renditions rendered in parallel processes")
+    ap.add_argument("--backend", choices=sorted(RENDER_BACKENDS), default="moviepy",
+                    help="moviepy: composite frames in Python; ffmpeg: one native filter_complex graph (much faster)")
+    ap.add_argument("--bench_bg", metavar="CLIP", help="Time the blurred-background paths on CLIP (ms/frame) and exit")
+    args = ap.parse_args()
+    if args.bench_bg:
+        bench_background(args.bench_bg)
+        raise SystemExit(0)
     while True:
-        main()
+        main(jobs=args.jobs, backend=args.backend)
         ans = input("\nGenerate more renditions? (Y/n): ").strip().lower()
         if ans.startswith("n"):
             print("Exiting generator.")